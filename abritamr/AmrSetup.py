@@ -1,6 +1,6 @@
-import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections,json
+import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections,json,importlib.util
 from abritamr.version import db
-from abritamr.CustomLog import CustomFormatter
+from abritamr.CustomLog import get_logger
 
 
 class Setup(object):
@@ -10,17 +10,7 @@ class Setup(object):
     def __init__(self, args):
         
 
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         
         
     def file_present(self, name):
@@ -48,17 +38,7 @@ class SetupAMR(Setup):
         # for amr
         self.species_list = json.load(open(f"{pathlib.Path(__file__).parent / 'species_config.json'}",'r'))
         
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
 
         
         self.jobs = args.jobs # number of amrfinderplus to run at a time
@@ -69,6 +49,15 @@ class SetupAMR(Setup):
         self.species = args.species if args.species in self.species_list else ""
         self.identity = args.identity
         self.amrfinder_db = args.amrfinder_db
+        self.stream = args.stream
+        self.no_cache = args.no_cache
+        self.cache_size = args.cache_size
+        self.retries = args.retries
+        self.pipeline = args.pipeline
+        self.multiplex = args.multiplex
+        self.resume = args.resume
+        self.stage_db = args.stage_db
+        self.prewarm_db = args.prewarm_db
 
         
 
@@ -95,8 +84,12 @@ class SetupAMR(Setup):
             firstline = data[0]
             if not firstline.startswith('>'):
                 for line in data:
-                    if len(line.split('\t')) != 2:
-                        self.logger.critical("Your input file should either be a tab delimited file with two columns or the path to contigs. Please check your input and try again.")
+                    row = line.split('\t')
+                    if len(row) not in [2, 3]:
+                        self.logger.critical("Your input file should either be a tab delimited file with two columns (or three, with the organism of each sample) or the path to contigs. Please check your input and try again.")
+                        raise SystemExit
+                    if len(row) == 3 and row[2] != '' and row[2] not in self.species_list:
+                        self.logger.critical(f"{row[2]} (for {row[0]}) is not a valid organism. The organism must be one of {', '.join(self.species_list)}. Please check your input and try again.")
                         raise SystemExit
                 run_type = 'batch'
         self.logger.info(f"The input file seems to be in the correct format. Thank you.")
@@ -134,8 +127,8 @@ class SetupAMR(Setup):
         if running_type == 'assembly':
             self._check_prefix()
         
-        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db'])
-        input_data = Data(running_type, self.contigs, self.prefix, self.jobs, self.species, self.identity, self.amrfinder_db)
+        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db', 'stream', 'no_cache', 'cache_size', 'retries', 'pipeline', 'multiplex', 'resume', 'stage_db', 'prewarm_db'])
+        input_data = Data(running_type, self.contigs, self.prefix, self.jobs, self.species, self.identity, self.amrfinder_db, self.stream, self.no_cache, self.cache_size, self.retries, self.pipeline, self.multiplex, self.resume, self.stage_db, self.prewarm_db)
         
         return input_data
 
@@ -147,17 +140,7 @@ class SetupMDU(Setup):
     def __init__(self, args):
         
 
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.db = db
         self.qc = args.qc
         self.runid = args.runid
@@ -165,6 +148,17 @@ class SetupMDU(Setup):
         self.partials = args.partials   
         self.sop = args.sop
         self.sop_name = args.sop_name
+        self.rules = args.rules
+        self.formats = args.formats
+
+    def _check_formats(self):
+        """
+        parquet is written with pyarrow, which is not needed otherwise
+        """
+        if 'parquet' in self.formats and importlib.util.find_spec("pyarrow") is None:
+            self.logger.critical(f"pyarrow is needed to save the report as parquet. Please install pyarrow or choose other formats.")
+            raise SystemExit
+        return True
 
     def _check_runid(self):
         if self.runid == '':
@@ -173,6 +167,27 @@ class SetupMDU(Setup):
         else:
             return True
 
+    def _check_files(self, file_dict):
+
+        self.logger.info(f"Now checking all input files are present.")
+        for _file in file_dict:
+            self.logger.info(f"Checking that {_file} is present.")
+            if self.file_present(file_dict[_file]):
+                self.logger.info(f"{file_dict[_file]} is present.")
+            else:
+                self.logger.critical(f"The {_file} file supplied ({file_dict[_file]}) does not exist. Please check your inputs and try again.")
+                raise SystemExit
+        return True
+
+    def check_report(self):
+        """
+        Check the inputs for a report made at the end of a run, before the run starts - the summaries are made by the run so are checked in setup.
+        """
+        file_dict = {'QC': self.qc}
+        if self.rules:
+            file_dict['rules'] = self.rules
+        return self._check_runid() and self._check_formats() and self._check_files(file_dict)
+
     def setup(self):
         """
         Check the inputs for MDU - ensure all files are present for collation.
@@ -187,19 +202,14 @@ class SetupMDU(Setup):
             'summary_matches': self.matches,
             # 'summary_partials':self.partials
             }
+        if self.rules:
+            file_dict['rules'] = self.rules
 
-        if self._check_runid():
+        if self._check_runid() and self._check_formats():
             self.logger.info(f"You are generating a {'general report' if self.sop == 'general' else 'species specific report'}")
-            self.logger.info(f"Now checking all input files are present.")
-            for _file in file_dict:
-                self.logger.info(f"Checking that {_file} is present.")
-                if self.file_present(file_dict[_file]):
-                    self.logger.info(f"{file_dict[_file]} is present.")
-                else:
-                    self.logger.critical(f"The {_file} file supplied ({file_dict[_file]}) does not exist. Please check your inputs and try again.")
-                    raise SystemExit
-
-            Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid', 'sop','sop_name'])
+            self._check_files(file_dict)
+
+            Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid', 'sop','sop_name', 'rules', 'formats'])
         
-            return Data(self.qc, self.matches, self.partials, self.db, self.runid, self.sop, self.sop_name)
+            return Data(self.qc, self.matches, self.partials, self.db, self.runid, self.sop, self.sop_name, self.rules, self.formats)
         
\ No newline at end of file
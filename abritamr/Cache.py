@@ -0,0 +1,124 @@
+import pathlib, hashlib, os, tempfile, shutil
+
+
+def cache_dir():
+    """
+    the directory abritamr keeps compiled and cached data in - set ABRITAMR_CACHE to change it
+    """
+    default = pathlib.Path.home() / ".cache" / "abritamr"
+    return pathlib.Path(os.environ.get("ABRITAMR_CACHE", f"{default}"))
+
+def sha256sum(path):
+    """
+    the sha256 of the contents of a file
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link_or_copy(src, dst):
+    """
+    hard link src to dst, or copy it if they are on different file systems - dst is replaced if it exists
+    """
+    dst = pathlib.Path(dst)
+    fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix=".tmp_")
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except OSError:
+        pathlib.Path(tmp).unlink(missing_ok=True)
+        raise
+    return dst
+
+def make_key(*parts):
+    """
+    a single cache key from several parts (hashes, versions, settings)
+    """
+    return hashlib.sha256(":".join(f"{p}" for p in parts).encode()).hexdigest()
+
+
+class FileCache:
+    """
+    A directory of files keyed on content hashes with a cap on its total size. Files are touched when they are used and the least recently used are removed first when the cache is over its cap.
+    """
+
+    def __init__(self, name, max_size):
+
+        self.path = cache_dir() / name
+        self.max_size = max_size # in bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, key):
+
+        return self.path / key[:2] / key
+
+    def get(self, key):
+        """
+        return the path of the cached file for key or None if it is not cached
+        """
+        f = self._file(key)
+        try:
+            os.utime(f)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return f
+
+    def put(self, key, data):
+        """
+        save data (bytes) for key - written to a temporary file first so a partial file is never used
+        """
+        f = self._file(key)
+        f.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=f.parent, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as t:
+                t.write(data)
+            os.replace(tmp, f)
+        except OSError:
+            pathlib.Path(tmp).unlink(missing_ok=True)
+            raise
+        return f
+
+    def put_file(self, key, src):
+        """
+        save the file src for key - hard linked where possible rather than copied
+        """
+        f = self._file(key)
+        f.parent.mkdir(parents=True, exist_ok=True)
+        return link_or_copy(src, f)
+
+    def evict(self):
+        """
+        remove the least recently used files until the cache is within its cap, return the number of files removed
+        """
+        if not self.path.exists():
+            return 0
+        files = []
+        for f in self.path.glob("*/*"):
+            if f.name.startswith(".tmp_"):
+                continue
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        files.sort()
+        total = sum(f[1] for f in files)
+        removed = 0
+        for mtime, size, f in files:
+            if total <= self.max_size:
+                break
+            f.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
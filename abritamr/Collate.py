@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
-import pathlib, pandas, math, sys,  re, logging, numpy
+import pathlib, pandas, math, sys,  re, logging, numpy, multiprocessing, heapq, csv, tempfile, io, json, hashlib, queue, threading, collections
+import concurrent.futures, xlsxwriter
 import warnings
 pandas.options.mode.chained_assignment = None
 # from pandas.core.algorithms import isin
-from abritamr.CustomLog import CustomFormatter
+from abritamr.CustomLog import get_logger, paused_logging
+from abritamr.RefGenes import RefGeneIndex, load_reftab, load_resolution, lookup_resolution
+from abritamr.Cache import FileCache, make_key
+from abritamr.ReportingRules import ReportingRules, RULES
+from abritamr.version import __version__
+
+# the collation object and reference index shared with forked collation workers - set before the pool is started so workers inherit them copy-on-write rather than having them pickled for each task
+_SHARED = {}
+
+def _classify_chunk(isolates):
+    """
+    load and classify the amrfinder output for a chunk of isolates in a worker
+    """
+    collator = _SHARED["collator"]
+    hits = collator._classify_isolates(reftab = _SHARED["reftab"], isolates = isolates)
+    return hits
 
 class Collate:
 
@@ -14,22 +30,31 @@ class Collate:
     ANNOTATIONS = {'blast':'*','partial':'^','exact':''}
     REFGENES = pathlib.Path(__file__).parent / "db" / "refgenes_latest.csv"
     MATCH = ["ALLELEX", "BLASTX", "EXACTX", "POINTX"]
+    AMRFINDER_DTYPES = {
+        "Gene symbol": str,
+        "Element type": str,
+        "Element subtype": str,
+        "Method": str,
+        "Accession of closest sequence": str,
+    }
+    MIN_CHUNK = 100 # smallest number of isolates to send to a collation worker
+    STREAM_CHUNK = 1000 # number of isolates held in memory at a time when streaming
+    BINS = {'summary_matches.txt': 'match', 'summary_partials.txt': 'partial', 'summary_virulence.txt': 'other'}
+    HIT_COLUMNS = ["Isolate", "bin", "drugclass", "drugname"]
+    cache = None # a FileCache of the classified hits for each isolate, None if not caching
+    failed = [] # isolates amrfinder failed for, these are left out of collation
+    _worker = None # the thread collating isolates as their amrfinder runs finish, None unless pipelined
 
     def __init__(self, args):
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.prefix = args.prefix
         self.run_type = args.run_type
         self.input = args.input
+        self.jobs = int(args.jobs)
+        self.stream = args.stream
+        self.failed = args.failed
+        if not args.no_cache:
+            self.cache = FileCache("collate", int(args.cache_size) * 1024 * 1024)
 
     def joins(self, dict_for_joining):
         """
@@ -42,31 +67,29 @@ class Collate:
 
         return dict_for_joining
 
+    def _get_refindex(self, reftab):
+        """
+        return a RefGeneIndex for reftab - reftab may already be an index, in which case it is used as is
+        """
+        if isinstance(reftab, RefGeneIndex):
+            return reftab
+        return RefGeneIndex(reftab)
+
     def get_drugclass(self, reftab, row, colname):
 
         """
         if the enhanced subclass is in either NONRTM or MACROLIDES then then use the groups specified by Norelle. If it is empty (-) then fall back on the AMRFinder subclass, else report the extended subclass
         """
         gene_id_col = "Gene symbol" if colname != "refseq_protein_accession" else "Accession of closest sequence" # to get the name of drug and the drugclass
+        refindex = self._get_refindex(reftab)
         
-        if reftab[reftab[colname] == row[1][gene_id_col]].empty:
-            d = 'Unknown'
-            for i in ['genbank_protein_accession','refseq_nucleotide_accession','genbank_nucleotide_accession']:
-                # print(reftab[reftab[i] == row[1][gene_id_col]])
-                if not reftab[reftab[i] == row[1][gene_id_col]].empty:
-                    d= reftab[reftab[i] == row[1][gene_id_col]]['enhanced_subclass'].values[0]
-                    break
-        else:
-            
-            d = reftab[reftab[colname] == row[1][gene_id_col]]['enhanced_subclass'].values[0]
-        
-        return d
+        return refindex.drugclass(colname = colname, gene_id = row[1][gene_id_col])
 
     def extract_bifunctional_name(self, protein, reftab):
         """
         extract the joint name of bifunctional genes
         """
-        return reftab[reftab["refseq_protein_accession"] == protein]["gene_family"].values[0]
+        return self._get_refindex(reftab).bifunctional_name(protein = protein)
 
     def extract_gene_name(self, protein, reftab, pointn = False):
         
@@ -74,52 +97,21 @@ class Collate:
         # amrfinderplus returns the nucleotide accession with the range for what was detected.. these
         # so extract just the name of accession and set col to work with to nucleotide rather than protein
         # Add POINTN to end so users know this is a different type of match 
-        suff = f"_POINTN" if pointn else ""
-        protein = protein.split(':')[0] if pointn else protein
-        col ="refseq_nucleotide_accession" if pointn else "refseq_protein_accession"
-        
-        try:
-            if reftab[reftab[col] == protein]["allele"].values[0] != '-':
-                nme = f"{reftab[reftab[col] == protein]['allele'].values[0]}{suff}"
-                return nme
-            else:
-                return reftab[reftab[col] == protein]["gene_family"].values[0]
-        except IndexError:
-            for i in ['genbank_protein_accession','refseq_nucleotide_accession','genbank_nucleotide_accession']:
-                if len(reftab[reftab[i] == protein]["gene_family"].unique()) >= 1:
-                    return reftab[reftab[i] == protein]["gene_family"].unique()[0]
+        return self._get_refindex(reftab).gene_name(protein = protein, pointn = pointn)
             
+    def resolve_hit(self, reftab, row, pointn = False):
+        """
+        return the drug class and the name to report for a single hit
+        """
+        return self._get_refindex(reftab).resolve(
+            symbol = row[1]["Gene symbol"], accession = row[1]["Accession of closest sequence"], method = row[1]["Method"], pointn = pointn
+            )
+
     def setup_dict(self, drugclass_dict, reftab, row, _type = 'exact', pointn = False):
         """
         return the dictionary for collation
         """
-        if row[1]["Gene symbol"] in list(reftab["allele"]) and 'POINT' not in row[1]['Method']:
-            drugclass = self.get_drugclass(
-                    reftab=reftab, row=row, colname="allele"
-                    )
-            drugname = self.extract_gene_name(protein = row[1]["Accession of closest sequence"], reftab = reftab, pointn = pointn)
-        elif row[1]["Gene symbol"] in list(reftab["allele"]) and 'POINT' in row[1]['Method']:
-            drugclass = self.get_drugclass(
-                    reftab=reftab, row=row, colname="allele"
-                    )
-            drugname = row[1]["Gene symbol"]
-            
-        elif row[1]["Gene symbol"] in list(reftab["gene_family"]):
-            
-            drugclass = self.get_drugclass(
-                reftab=reftab, row=row, colname="refseq_protein_accession"
-            )
-            drugname = f"{self.extract_gene_name(protein = row[1]['Accession of closest sequence'], reftab = reftab)}*" if not row[1]["Method"] in ["EXACTX", "ALLELEX"] else f"{self.extract_gene_name(protein = row[1]['Accession of closest sequence'], reftab = reftab)}"
-            
-        elif row[1]["Accession of closest sequence"] in list(reftab["refseq_protein_accession"]):
-            
-            drugclass = self.get_drugclass(
-                reftab = reftab, row = row, colname = "refseq_protein_accession"
-            )
-            drugname = self.extract_bifunctional_name(protein = row[1]['Accession of closest sequence'], reftab = reftab)
-        else:
-            drugname = row[1]["Gene symbol"]
-            drugclass = "Unknown"
+        drugclass, drugname = self.resolve_hit(reftab = reftab, row = row, pointn = pointn)
 
         if drugclass in drugclass_dict:
             drugclass_dict[drugclass].append(drugname)
@@ -138,28 +130,62 @@ class Collate:
             other_dict[row[1]['Element subtype'].capitalize()] = [row[1]['Gene symbol']]
         return other_dict
 
+    def classify(self, reftab, df):
+        """
+        sort every hit in df into match, partial or other bins and attach the drug class and name to report. Hits that are a match are ALLELEX, POINTX, EXACTX or BLASTX (or POINTN), all other AMR hits are partials and virulence and stress genes are other.
+        The drug class and name are resolved once for each distinct (Gene symbol, Accession, Method) - from the resolution table compiled with the refgenes snapshot where possible, otherwise through the RefGeneIndex - and merged back on to the hits.
+        """
+        reftab = self._get_refindex(reftab)
+        hits = df.reset_index(drop = True)
+        method = hits["Method"]
+        amr = (hits["Element type"] == "AMR") & (hits["Element subtype"] != "AMR-SUSCEPTIBLE")
+        always_partial = (hits["Gene symbol"] == "aac(6')-Ib-cr") & method.isin(["EXACTX", "ALLELEX"]) # This is always a partial - unclear
+        match = ~always_partial & method.isin(self.MATCH) & amr
+        pointn = ~always_partial & ~match & method.str.contains("POINTN", regex = False).fillna(False).astype(bool) & amr
+        partial = always_partial | (~match & ~pointn & ~method.isin(self.MATCH) & amr)
+        
+        hits["bin"] = numpy.select([match | pointn, partial], ["match", "partial"], default = "other")
+        hits["pointn"] = pointn
+        keys = ["Gene symbol", "Accession of closest sequence", "Method", "pointn"]
+        distinct = hits.loc[hits["bin"] != "other", keys].drop_duplicates()
+        resolution = load_resolution(snapshot = reftab.snapshot)
+        rows = list(zip(distinct.index, distinct.to_dict(orient = "records")))
+        table = lookup_resolution(resolution = resolution, keys = [(r["Gene symbol"], r["Accession of closest sequence"], r["Method"]) for i, r in rows]) if resolution is not None else [None] * len(rows)
+        resolved = []
+        for (i, r), found in zip(rows, table):
+            # point mutations carry their position in the accession so are never in the table
+            if found is not None and not r["pointn"]:
+                resolved.append(found)
+            else:
+                resolved.append(self.resolve_hit(reftab = reftab, row = (i, r), pointn = r["pointn"]))
+        distinct["drugclass"] = [r[0] for r in resolved]
+        distinct["drugname"] = [r[1] for r in resolved]
+        hits = hits.merge(distinct, on = keys, how = "left")
+        
+        other = hits["bin"] == "other"
+        hits.loc[other, "drugclass"] = hits.loc[other, "Element subtype"].str.capitalize()
+        hits.loc[other, "drugname"] = hits.loc[other, "Gene symbol"]
+        
+        return hits
+
+    def _join_bin(self, hits, _bin, isolate):
+        """
+        make a comma separated list of the names in each drug class for one bin
+        """
+        binned = hits[hits["bin"] == _bin]
+        d = {"Isolate": isolate}
+        joined = binned.groupby("drugclass", sort = False, dropna = False)["drugname"].agg(lambda x: ",".join(sorted(set(x))))
+        d.update(joined.to_dict())
+        return d
+
     def get_per_isolate(self, reftab, df, isolate):
         """
         make three dictionaries for each isolate that contain the drug class assignments for each match that is one of ALLELEX,POINTX, EXACTX or BLASTX, another dictionary which lists all partial mathces and a dictionary of virulence factors
         """
-        drugclass_dict = {"Isolate": isolate}
-        partials = {"Isolate": isolate}
-        other = {"Isolate": isolate}
-        for row in df.iterrows():
-            # if the match is good then generate a drugclass dict
-            if row[1]["Gene symbol"] == "aac(6')-Ib-cr" and row[1]["Method"] in ["EXACTX", "ALLELEX"]: # This is always a partial - unclear
-                partials = self.setup_dict(drugclass_dict = partials, reftab = reftab, row = row)
-            elif row[1]["Method"] in self.MATCH and row[1]["Element type"] == "AMR" and row[1]['Element subtype'] != "AMR-SUSCEPTIBLE":
-                drugclass_dict = self.setup_dict(drugclass_dict = drugclass_dict, reftab = reftab, row = row)
-            elif "POINTN" in row[1]["Method"] and row[1]["Element type"] == "AMR" and row[1]['Element subtype'] != "AMR-SUSCEPTIBLE":
-                drugclass_dict = self.setup_dict(drugclass_dict = drugclass_dict, reftab = reftab, row = row, pointn = True)
-            elif row[1]["Method"] not in self.MATCH and row[1]["Element type"] == "AMR" and row[1]['Element subtype'] != "AMR-SUSCEPTIBLE":
-                partials = self.setup_dict(drugclass_dict = partials, reftab = reftab, row = row)
-            else:
-                other = self._other_dict(other_dict = other, row = row)
-        drugclass_dict = self.joins(dict_for_joining=drugclass_dict)
-        partials = self.joins(dict_for_joining=partials)
-        other = self.joins(dict_for_joining = other)
+        hits = self.classify(reftab = reftab, df = df)
+        drugclass_dict = self._join_bin(hits = hits, _bin = "match", isolate = isolate)
+        partials = self._join_bin(hits = hits, _bin = "partial", isolate = isolate)
+        other = self._join_bin(hits = hits, _bin = "other", isolate = isolate)
         return drugclass_dict, partials, other
 
     def _get_cols(self, df, _not = 'Isolate'):
@@ -242,24 +268,29 @@ class Collate:
 
     def _get_reftab(self):
         """
-        get reftab
+        get reftab - from the compiled snapshot of refgenes, which is only read once per process
         """
 
-        reftab = pandas.read_csv(self.REFGENES)
-        reftab = reftab.fillna("-")
+        reftab = load_reftab(self.REFGENES)
 
         return reftab
 
-    def collate(self, prefix = ''):
+    def _read_amrfinder(self, path):
+        """
+        read only the columns of an amrfinder output that are needed for collation
+        """
+        return pandas.read_csv(path, sep = "\t", usecols = list(self.AMRFINDER_DTYPES), dtype = self.AMRFINDER_DTYPES)
+
+    def collate(self, prefix = '', reftab = None):
         """
         if the refgenes.csv is present then proceed to collate data and save the csv files.
         """
 
+        if reftab is None:
+            reftab = self._get_refindex(self._get_reftab())
         
-        reftab = self._get_reftab()
-        
-        df = pandas.read_csv(f"{prefix}/amrfinder.out", sep="\t")
-        self.logger.info(f"Opened amrfinder output for {prefix}")
+        df = self._read_amrfinder(f"{prefix}/amrfinder.out")
+        self.logger.info(f"Opened amrfinder output for {prefix}", extra = {"isolate": prefix})
         drug, partial, virulence = self.get_per_isolate(
             reftab=reftab, df=df, isolate=prefix
         )
@@ -269,38 +300,245 @@ class Collate:
         summary_virulence = pandas.DataFrame(virulence, index = [0])
         return summary_drugs, summary_partial,summary_virulence
         
-    
-    def _combine_df(self, existing, temp):
+    def _get_isolates(self, input_file):
         """
-        combine result dataframes for batch
+        the isolates (output directories) listed in column 1 of the batch input file, less any that amrfinder failed for
         """
-        if existing.empty:
-            existing = temp
-        else:
-            existing = pandas.concat([existing,temp])
+        df = pandas.read_csv(input_file, sep = '\t', header = None, usecols = [0])
+        return [f"{i}" for i in df[0] if f"{i}" not in self.failed]
+
+    def _load_batch(self, isolates, contents = None):
+        """
+        read the amrfinder output of every isolate into one long table, with the isolate in the Isolate column. contents is the amrfinder output for each isolate if it has already been read
+        """
+        tabs = []
+        for isolate in isolates:
+            tab = self._read_amrfinder(io.BytesIO(contents[isolate]) if contents else f"{isolate}/amrfinder.out")
+            tab["Isolate"] = isolate
+            tabs.append(tab)
+        self.logger.info(f"Opened amrfinder output for {len(tabs)} isolates")
+        return pandas.concat(tabs, ignore_index = True)
+
+    def _summarise(self, hits, _bin, isolates):
+        """
+        make the summary table for one bin - a row per isolate (in input order) and a column per drug class (in the order they were first seen)
+        """
+        binned = hits[hits["bin"] == _bin]
+        if binned.empty:
+            return pandas.DataFrame({"Isolate": isolates})
+        cols = list(binned["drugclass"].drop_duplicates())
+        joined = binned.groupby(["Isolate", "drugclass"], sort = False, dropna = False)["drugname"].agg(lambda x: ",".join(sorted(set(x))))
+        summary = joined.unstack("drugclass").reindex(index = isolates, columns = cols)
+        summary.columns.name = None
+        summary.index.name = "Isolate"
+        return summary.reset_index()
+
+    def _classify_isolates(self, reftab, isolates):
+        """
+        the classified hits for isolates - from the cache where the amrfinder output, refgenes and abritamr version are unchanged
+        """
+        if self.cache is None or reftab.digest is None:
+            hits = self.classify(reftab = reftab, df = self._load_batch(isolates = isolates))
+            return hits[self.HIT_COLUMNS]
+        
+        rows = {}
+        keys = {}
+        contents = {}
+        for isolate in dict.fromkeys(isolates):
+            data = pathlib.Path(f"{isolate}/amrfinder.out").read_bytes()
+            keys[isolate] = make_key(hashlib.sha256(data).hexdigest(), reftab.digest, __version__)
+            cached = self.cache.get(keys[isolate])
+            if cached is not None:
+                rows[isolate] = json.loads(cached.read_bytes())
+            else:
+                contents[isolate] = data
+        self.logger.info(f"{len(rows)} of {len(keys)} isolates collated from cache")
+        
+        if contents:
+            hits = self.classify(reftab = reftab, df = self._load_batch(isolates = list(contents), contents = contents))
+            for isolate in contents:
+                rows[isolate] = []
+            for isolate, _bin, drugclass, drugname in hits[self.HIT_COLUMNS].itertuples(index = False):
+                rows[isolate].append([_bin, drugclass, drugname])
+            for isolate in contents:
+                self.cache.put(keys[isolate], json.dumps(rows[isolate]).encode())
         
-        return existing
+        return pandas.DataFrame([[isolate] + r for isolate in isolates for r in rows[isolate]], columns = self.HIT_COLUMNS)
 
-    def _batch_collate(self,input_file):
+    def _chunks(self, isolates, jobs):
+        """
+        split isolates into consecutive chunks - a few per job so that workers stay busy
+        """
+        size = max(self.MIN_CHUNK, math.ceil(len(isolates) / (jobs * 4)))
+        return [isolates[i:i + size] for i in range(0, len(isolates), size)]
 
+    def _parallel_classify(self, reftab, isolates, jobs):
+        """
+        classify the hits for all isolates with a pool of forked workers - results are returned in the order of the input
+        """
+        chunks = self._chunks(isolates = isolates, jobs = jobs)
+        self.logger.info(f"Collating {len(isolates)} isolates in {len(chunks)} chunks with {jobs} processes")
+        _SHARED.update({"collator": self, "reftab": reftab})
+        # the log listener thread is stopped while the pool is forked and running - forking with other threads running can deadlock on the locks they hold
+        try:
+            with paused_logging(), multiprocessing.get_context("fork").Pool(processes = min(jobs, len(chunks))) as pool:
+                hits = pool.map(_classify_chunk, chunks)
+        finally:
+            _SHARED.clear()
+        return pandas.concat(hits, ignore_index = True)
 
-        summary_matches = pandas.DataFrame()
-        summary_partial = pandas.DataFrame()
-        summary_virulence = pandas.DataFrame()
+    def start_pipeline(self):
+        """
+        start a worker that collates each isolate as it is added, so that collation overlaps with amrfinder. The summaries are made from these when the batch is collated.
+        """
+        self._reftab = self._get_refindex(self._get_reftab())
+        self._queue = queue.Queue()
+        self._collated = {}
+        self._errors = []
+        self._worker = threading.Thread(target = self._pipeline_worker, daemon = True)
+        self._worker.start()
+
+    def add(self, isolate):
+        """
+        queue an isolate, whose amrfinder output is complete, for collation
+        """
+        self._queue.put(isolate)
 
-        df = pandas.read_csv(input_file, sep = '\t', header = None)
-        for row in df.iterrows():
-            prefix = f"{row[1][0]}"
-            self.logger.info(f"Collating results for {prefix}")
-            temp_match, temp_partial, temp_virulence = self.collate(prefix = prefix)
-            summary_matches = self._combine_df(existing = summary_matches, temp = temp_match)
-            summary_partial = self._combine_df(existing = summary_partial, temp = temp_partial)
-            summary_virulence = self._combine_df(existing = summary_virulence, temp = temp_virulence)
+    def _pipeline_worker(self):
+        """
+        collate queued isolates - all those waiting are taken together. None marks the end of the queue.
+        """
+        done = False
+        while not done:
+            isolates = [self._queue.get()]
+            while not self._queue.empty():
+                isolates.append(self._queue.get_nowait())
+            done = None in isolates
+            isolates = [i for i in dict.fromkeys(isolates) if i is not None and i not in self._collated]
+            if not isolates:
+                continue
+            try:
+                hits = self._classify_isolates(reftab = self._reftab, isolates = isolates)
+            except Exception as e:
+                self._errors.append(e)
+                return
+            for isolate, rows in hits.groupby("Isolate", sort = False):
+                self._collated[isolate] = rows
+            for isolate in isolates:
+                self._collated.setdefault(isolate, hits.iloc[:0])
+
+    def _finish_pipeline(self, isolates):
+        """
+        wait for the worker and return the hits of isolates in order - any isolate that was not added is collated now
+        """
+        self._queue.put(None)
+        self._worker.join()
+        if self._errors:
+            raise self._errors[0]
+        missing = [i for i in dict.fromkeys(isolates) if i not in self._collated]
+        if missing:
+            hits = self._classify_isolates(reftab = self._reftab, isolates = missing)
+            for isolate in missing:
+                self._collated[isolate] = hits[hits["Isolate"] == isolate]
+        self.logger.info(f"{len(self._collated) - len(missing)} isolates were collated while amrfinder was running")
+        return pandas.concat([self._collated[i] for i in isolates], ignore_index = True)
+
+    def _batch_collate(self,input_file, jobs = 1):
+
+        reftab = self._get_refindex(self._get_reftab())
+        isolates = self._get_isolates(input_file = input_file)
+        self.logger.info(f"Collating results for {len(isolates)} isolates")
+        if self._worker is not None:
+            hits = self._finish_pipeline(isolates = isolates)
+        elif jobs > 1 and len(isolates) > self.MIN_CHUNK and "fork" in multiprocessing.get_all_start_methods():
+            hits = self._parallel_classify(reftab = reftab, isolates = isolates, jobs = jobs)
+        else:
+            hits = self._classify_isolates(reftab = reftab, isolates = isolates)
+        summary_matches = self._summarise(hits = hits, _bin = "match", isolates = isolates)
+        summary_partial = self._summarise(hits = hits, _bin = "partial", isolates = isolates)
+        summary_virulence = self._summarise(hits = hits, _bin = "other", isolates = isolates)
         
         return summary_matches, summary_partial, summary_virulence
 
-    def run(self):
+    def _stream_columns(self, reftab, chunks, tmp):
+        """
+        first pass of streaming collation - classify each chunk, find the drug classes in each bin in the order they are first seen and save the classified hits of each chunk in tmp for the second pass
+        """
+        cols = {b: [] for b in self.BINS.values()}
+        saved = []
+        for n, chunk in enumerate(chunks):
+            hits = self._classify_isolates(reftab = reftab, isolates = chunk)
+            for b in cols:
+                seen = hits.loc[hits["bin"] == b, "drugclass"].drop_duplicates()
+                cols[b].extend([c for c in seen if c not in cols[b]])
+            saved.append(f"{tmp}/hits_{n}.pkl")
+            hits.to_pickle(saved[-1])
+        return cols, saved
+
+    def _merge_runs(self, runs, header, out):
+        """
+        merge chunks of the combined table (each already sorted on isolate) in to one file sorted on isolate
+        """
+        key = lambda line: next(csv.reader([line], delimiter = '\t'))[0]
+        handles = [open(r, 'r', newline = '') for r in runs]
+        try:
+            with open(out, 'w', newline = '') as f:
+                f.write(header)
+                f.writelines(heapq.merge(*handles, key = key))
+        finally:
+            for h in handles:
+                h.close()
+
+    def _stream_collate(self, input_file, path = ''):
+        """
+        collate a batch a chunk of isolates at a time and write the rows for each summary file as they are made, so that memory use does not grow with the number of isolates.
+        The columns of each file are settled in a first pass, which keeps the classified hits of each chunk on disk for the second. The combined abritamr.txt is sorted on isolate, so each chunk is saved sorted and the chunks are merged at the end.
+        """
+        reftab = self._get_refindex(self._get_reftab())
+        isolates = self._get_isolates(input_file = input_file)
+        chunks = [isolates[i:i + self.STREAM_CHUNK] for i in range(0, len(isolates), self.STREAM_CHUNK)]
+        self.logger.info(f"Streaming collation of {len(isolates)} isolates in {len(chunks)} chunks")
+        combd_out = f"{path}/abritamr.txt" if path != '' else f"abritamr.txt"
+        combd_header = ''
+        runs = []
+        with tempfile.TemporaryDirectory(dir = path if path != '' else '.') as tmp:
+            cols, saved = self._stream_columns(reftab = reftab, chunks = chunks, tmp = tmp)
+            outs = {f: open(f"{path}/{f}" if path != '' else f"{f}", 'w', newline = '') for f in self.BINS}
+            try:
+                for n, chunk in enumerate(chunks):
+                    hits = pandas.read_pickle(saved[n])
+                    tables = {}
+                    for f, b in self.BINS.items():
+                        tables[b] = self._summarise(hits = hits, _bin = b, isolates = chunk).reindex(columns = ['Isolate'] + cols[b])
+                        tables[b].set_index('Isolate').to_csv(outs[f], sep = '\t', header = n == 0)
+                    combd = self._combine_dfs(match = tables['match'], partial = tables['partial'], virulence = tables['other'])
+                    if not combd.empty:
+                        combd_header = combd.head(0).set_index('Isolate').to_csv(sep = '\t')
+                        runs.append(f"{tmp}/run_{n}.txt")
+                        combd.set_index('Isolate').to_csv(runs[-1], sep = '\t', header = False)
+            finally:
+                for f in outs.values():
+                    f.close()
+            if runs:
+                self.logger.info(f"Saving combined file : {combd_out}")
+                self._merge_runs(runs = runs, header = combd_header, out = combd_out)
+        
+        return True
 
+    def _evict(self):
+        """
+        keep the collation cache within its size limit
+        """
+        if self.cache is not None:
+            removed = self.cache.evict()
+            if removed:
+                self.logger.info(f"Removed {removed} entries from the collation cache.")
+        return True
+
+    def run(self):
+        """
+        collate the amrfinder results and save the summaries - return the matches and partials tables, or None if they were streamed to file
+        """
 
         if not pathlib.Path(self.REFGENES).exists():
             self.logger.critical(f"The refgenes DB ({self.REFGENES}) seems to be missing.")
@@ -309,26 +547,26 @@ class Collate:
         if self.run_type != 'batch':
             self.logger.info(f"This is a single sample run.")
             summary_drugs, summary_partial, virulence = self.collate(prefix = self.prefix)
+        elif self.stream:
+            self.logger.info(f"You are running abritamr in batch mode. Your collated results will be written as they are collated.")
+            self._stream_collate(input_file = self.input)
+            self._evict()
+            return None
         else:
             self.logger.info(f"You are running abritamr in batch mode. Your collated results will be saved.")
-            summary_drugs, summary_partial, virulence = self._batch_collate(input_file = self.input)
+            summary_drugs, summary_partial, virulence = self._batch_collate(input_file = self.input, jobs = self.jobs)
         self.logger.info(f"Saving files now.")
         self.save_files(path='' if self.run_type == 'batch' else f"{self.prefix}", match = summary_drugs,partial=summary_partial, virulence = virulence)
+        self._evict()
+        return summary_drugs, summary_partial
         
 class MduCollate(Collate):
+
+    _qc = None # the QC table indexed on ISOLATE, read once
+    MDUID = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,})?')
     
     def __init__(self, args):
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.sop = args.sop
         self.sop_name = args.sop_name
         self.mduqc = args.qc
@@ -336,13 +574,8 @@ class MduCollate(Collate):
         self.partials = args.partials
         self.match = args.matches
         self.runid = args.runid
-        self.NONE_CODES = {
-            "Salmonella":"CPase_ESBL_AmpC_16S_NEG",
-            "Shigella":"CPase_ESBL_AmpC_16S_NEG",
-            "Staphylococcus":"Mec_VanAB_Linez_NEG",
-            "Enterococcus":"Van_Linez_NEG",
-            "Other":"CPase_16S_mcr_NEG"
-        }
+        self.formats = args.formats
+        self.rules = ReportingRules(path = args.rules if args.rules else RULES, sop = "general")
         self.REPORTING = {"Salmonella enterica":self.mdu_reporting_salmonella}
 
     def mdu_qc_tab(self):
@@ -359,6 +592,49 @@ class MduCollate(Collate):
         
         return pandas.concat([tab,pos])
 
+    def _read_summary(self, summary):
+        """
+        a summary table - summary is either the path of a summary file or the table itself, as handed over by a run
+        """
+        if isinstance(summary, pandas.DataFrame):
+            return summary
+        return pandas.read_csv(summary, sep = '\t')
+
+    def _mduids(self, isolates):
+        """
+        the MDU sample ID and item code of each isolate
+        """
+        self.logger.info(f"Extracting MDU sample IDs and item codes")
+        ids = isolates.astype(str)
+        parts = ids.str.extract(f"^{self.MDUID.pattern}")
+        return list(parts['id'].fillna(ids.str.split('/').str[-1])), list(parts['itemcode'].fillna(''))
+
+    def _qc_index(self):
+        """
+        the QC table indexed on ISOLATE - read once and, if an isolate is in it more than once, its first row kept
+        """
+        if self._qc is None:
+            qc = self.mdu_qc_tab()
+            self._qc = qc.drop_duplicates(subset = 'ISOLATE').set_index('ISOLATE')
+        return self._qc
+
+    def _qc_lookup(self, isolates):
+        """
+        the QC row of each isolate - matched exactly, or if there is no exact match the first ISOLATE that contains it
+        """
+        qc = self._qc_index()
+        found = []
+        for isolate in isolates:
+            isolate = f"{isolate}"
+            if isolate not in qc.index:
+                hits = qc.index[qc.index.str.contains(isolate, regex = False, na = False)]
+                if len(hits) == 0:
+                    self.logger.critical(f"{isolate} is not in the QC file {self.mduqc}. Please check your input and try again.")
+                    raise SystemExit
+                isolate = hits[0]
+            found.append(isolate)
+        return qc.loc[found]
+
     def strip_bla(self, gene):
         '''
         strip bla from front of genes except
@@ -370,6 +646,7 @@ class MduCollate(Collate):
         return gene
 
 
+    # the general sop (the rules are in reporting_rules.json)
     # Carbapenemase to be reported for all cases
     # Carbapenemase (MBL) all in all HOWEVER if blaL1 should  not be reported in Stenotrophomonas maltophilia
     # Carbapenemase (OXA-51 family) REPORTED IN ALL except in Acinetobacter baumannii,Acinetobacter calcoaceticus,Acinetobacter nosocomialis,Acinetobacter pittii,Acinetobacter baumannii complex,
@@ -394,10 +671,7 @@ class MduCollate(Collate):
 
     def none_replacement_code(self, genus):
 
-        if genus in self.NONE_CODES:
-            return self.NONE_CODES[genus]
-        else:
-            return "CPase_16S_mcr_NEG"
+        return self.rules.negative_code(species = genus)
 
     def assign_itemcode(self,mduid, reg):
         self.logger.info(f"Checking for item code")
@@ -513,28 +787,11 @@ class MduCollate(Collate):
             return gene
         return ''
     
-    def reporting_logic_salmonella(self, row):
-
-        # Ampicillin - ResMech	Ampicillin - Interpretation	
-        # Cefotaxime (ESBL) - ResMech	Cefotaxime (ESBL) - Interpretation	
-        # Cefotaxime (AmpC) - ResMech	Cefotaxime (AmpC) - Interpretation	
-        # Tetracycline - ResMech	Tetracycline - Interpretation	
-        # Gentamycin - ResMech	Gentamycin - Interpretation	
-        # Sulfathiazole - ResMech	Sulfathiazole - Interpretation	
-        # Trimethoprim - ResMech	Trimethoprim - Interpretation	
-        # Ciprofloxacin - ResMech	Ciprofloxacin - Interpretation	
-        # Azithromycin - ResMech	Azithromycin - Interpretation
-
-        mduidreg = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,})?')
-        
-        all_genes = self.get_all_genes(row)
-        all_genes = [a for a in all_genes if a != row[1]['Isolate'] and a != '']
-                
-        isodict = row[1].to_dict()
-        item_code = self.assign_itemcode(f"{row[1]['Isolate']}", mduidreg)
-        md = self.assign_mduid(f"{row[1]['Isolate']}", mduidreg)
-
-        abx = {
+    def _salmonella_abx(self):
+        """
+        the check of each antibiotic reported for Salmonella - called with a drug class column and its genes, returns the genes if they confer resistance to the antibiotic
+        """
+        return {
             "Ampicillin" : self._ampicillin_res_sal,
             "Cefotaxime (ESBL)":self._cefo_esbl_res_sal,
             "Cefotaxime (AmpC)":self._cefo_ampc_res_sal,
@@ -554,6 +811,37 @@ class MduCollate(Collate):
             "Colistin":self._colistin_res_salmo
         }
 
+    def _salmonella_matrix(self, columns):
+        """
+        a boolean matrix of the drug class columns against the antibiotics reported for Salmonella, True where genes in the column confer resistance to the antibiotic. Trim-Sulpha is worked out from Trimethoprim and Sulfathiazole so is not in it.
+        """
+        abx = {ab: check for ab, check in self._salmonella_abx().items() if ab != 'Trim-Sulpha'}
+        return pandas.DataFrame(
+            [[check(col = col, gene = 'gene') != '' for check in abx.values()] for col in columns],
+            index = columns, columns = list(abx), dtype = bool
+        )
+
+    def reporting_logic_salmonella(self, row):
+
+        # Ampicillin - ResMech	Ampicillin - Interpretation	
+        # Cefotaxime (ESBL) - ResMech	Cefotaxime (ESBL) - Interpretation	
+        # Cefotaxime (AmpC) - ResMech	Cefotaxime (AmpC) - Interpretation	
+        # Tetracycline - ResMech	Tetracycline - Interpretation	
+        # Gentamycin - ResMech	Gentamycin - Interpretation	
+        # Sulfathiazole - ResMech	Sulfathiazole - Interpretation	
+        # Trimethoprim - ResMech	Trimethoprim - Interpretation	
+        # Ciprofloxacin - ResMech	Ciprofloxacin - Interpretation	
+        # Azithromycin - ResMech	Azithromycin - Interpretation
+
+        all_genes = self.get_all_genes(row)
+        all_genes = [a for a in all_genes if a != row[1]['Isolate'] and a != '']
+                
+        isodict = row[1].to_dict()
+        item_code = self.assign_itemcode(f"{row[1]['Isolate']}", self.MDUID)
+        md = self.assign_mduid(f"{row[1]['Isolate']}", self.MDUID)
+
+        abx = self._salmonella_abx()
+
         
         tmp_results = {
             "Ampicillin":[],	
@@ -595,7 +883,7 @@ class MduCollate(Collate):
         # for Trim-Sulpha
         
         if tmp_results['Trimethoprim'] != [] and tmp_results['Sulfathiazole'] != []:
-            tmp_results['Trim-Sulpha'] = list(set(tmp_results['Trimethoprim']).union(tmp_results['Sulfathiazole']))
+            tmp_results['Trim-Sulpha'] = list(dict.fromkeys(tmp_results['Trimethoprim'] + tmp_results['Sulfathiazole']))
         
         for res in tmp_results:
             results[f"{res} - ResMech"] = ';'.join(tmp_results[res]) if tmp_results[res] != [] else "None detected"              
@@ -617,99 +905,38 @@ class MduCollate(Collate):
         return results
 
             
-    def reporting_logic_general(self, row, species, neg_code = True):
-        
-        # get all genes found
-        all_genes = self.get_all_genes(row)
-        isodict = row[1].to_dict()
-        # determine the genus EXPECTED
-        genus = species.split()[0]
-        reportable = [
-            "Carbapenemase",
-            "Carbapenemase (MBL)",
-            "ESBL (KPC variant)"
-            "Carbapenemase (OXA-51 family)",
-            "ESBL",
-            "AmpC", # will need to change to reflect new subclass AmpC
-            "Aminoglycosides (Ribosomal methyltransferase)",
-            "Colistin",
-            "Chloramphenicol/Florfenicol/Linezolid", 
-            "Florfenicol/Oxazolidinone",
-            "Vancomycin",
-            "Methicillin"
-        ]
-        non_caveat_reportable = [
-            "Carbapenemase",
-            "ESBL (KPC variant)",
-            "Aminoglycosides (Ribosomal methyltransferase)",
-            "Colistin"
-        ]
-        # Carbapenemase (KPC variant)
-# Carbapenemase (MBL)
-# Carbapenemase (OXA-51 family)
-
-        abacter_excluded = [
-            "Acinetobacter baumannii",
-            "Acinetobacter calcoaceticus",
-            "Acinetobacter nosocomialis",
-            "Acinetobacter pittii",
-            "Acinetobacter baumannii complex"
-        ]
-
-        
-        van_match = re.compile(r"van[A,B,C,D,E,G,L,M,N][\S]*")
-        mec_match = re.compile(r"mec[^IR]")
-        
-        genes_reported = []  # genes for reporting
-        genes_not_reported = []  # genes found but not reportable
-        for i in isodict:
-            genes = []
-            if i != 'Isolate':
-                if isinstance(isodict[i], str):
-                    genes = isodict[i].split(',')
-                    genes = [gene for gene in genes if '_' not in gene] # this is to remove the point mutations for MMS118
-                if genes != []: # for each bin we do things to genes
-                    if i in reportable: #don't report point mutations
-                        # print(i)
-                        if i in non_caveat_reportable:
-                            genes_reported.extend(genes)
-                        elif i == "Carbapenemase (MBL)" and species != "Stenotrophomonas maltophilia":
-                            genes_reported.extend(genes)
-                        elif i == "Carbapenemase (MBL)" and species == "Stenotrophomonas maltophilia":
-                            # if species is "Stenotrophomonas maltophilia" don't report blaL1
-                            genes_reported.extend([g for g in genes if not g.startswith("blaL1")])
-                            genes_not_reported.extend([g for g in genes if g.startswith("blaL1")])
-                        elif i == "Carbapenemase (OXA-51 family)" and species not in abacter_excluded:
-                            genes_reported.extend(genes)
-                        elif i in ["ESBL","AmpC"] and genus in ["Salmonella"]: 
-                            genes_reported.extend(genes)
-                        elif i in ["ESBL","AmpC"] and genus in ["Shigella"]: 
-                            genes_reported.extend([g for g in genes if "blaEC" not in g])
-                            genes_not_reported.extend([g for g in genes if "blaEC" in g]) # don't report blaEC for shigella
-                        elif i == "Vancomycin":
-                            genes_reported.extend([g for g in genes if van_match.match(g)])
-                            genes_not_reported.extend([g for g in genes if not van_match.match(g)])
-                        elif i == "Methicillin":
-                            genes_reported.extend([g for g in genes if mec_match.match(g)])
-                            genes_not_reported.extend([g for g in genes if not mec_match.match(g)])
-                        
-                        elif "Oxazolidinone" in i or "Linezolid" in i:
-                            if species in ["Staphylococcus aureus","Staphylococcus argenteus"] or genus == "Enterococcus":
-                                genes_reported.extend(genes)
-                            else:
-                                genes_not_reported.extend(genes)
-                        else:
-                            genes_not_reported.extend(genes)
-
-                    else:
-                        genes_not_reported.extend(genes)
+    def _split_genes(self, isodict):
+        """
+        the genes of each drug class of an isolate, in column order - point mutations are not reported (MMS118)
+        """
+        for col, value in isodict.items():
+            if col != 'Isolate' and isinstance(value, str):
+                for gene in value.split(','):
+                    if '_' not in gene:
+                        yield col, gene
+
+    def _negative_codes(self, genes_reported, genes_not_reported, species, neg_code = True):
+
         if genes_reported == []:
-            genes_reported = [self.none_replacement_code(genus= genus)] if neg_code else ''
+            genes_reported = [self.rules.negative_code(species = species)] if neg_code else ''
         if genes_not_reported == []:
             genes_not_reported = ["No non-reportable genes found."] if neg_code else ''
-            # break
+        return genes_reported, genes_not_reported
+
+    def reporting_logic_general(self, row, species, neg_code = True):
+        """
+        the reportable and non-reportable genes of one isolate - row is (index, the isolate's row of the summary as a Series or dict)
+        """
+        genes_reported = []  # genes for reporting
+        genes_not_reported = []  # genes found but not reportable
+        for col, gene in self._split_genes(dict(row[1])):
+            if self.rules.reportable(col = col, gene = gene, species = species):
+                genes_reported.append(gene)
+            else:
+                genes_not_reported.append(gene)
+        genes_reported, genes_not_reported = self._negative_codes(genes_reported, genes_not_reported, species = species, neg_code = neg_code)
         
-        self.logger.info(f"{row[1]['Isolate']} has {len(genes_reported)} reportable genes.")
+        self.logger.info(f"{row[1]['Isolate']} has {len(genes_reported)} reportable genes.", extra = {"isolate": row[1]['Isolate']})
         return genes_reported, genes_not_reported
 
     def mdu_reporting_salmonella(self, match, isolates):
@@ -738,77 +965,151 @@ class MduCollate(Collate):
         "Other - Interpretation"]
         # select passed Salmonella
         
-        df = pandas.read_csv(match, sep = '\t')
+        df = self._read_summary(match)
         df = df[df['Isolate'].isin(isolates)]
-        result_df = pandas.DataFrame()
-        df = df.fillna('')
-        for row in df.iterrows():
-            isolate_results = self.reporting_logic_salmonella(row = row)
-            tmpdf = pandas.DataFrame(isolate_results, index = [0])
-            if result_df.empty:
-                result_df = tmpdf
+        df = df.fillna('').reset_index(drop = True)
+        classes = [c for c in df.columns if c != 'Isolate']
+        matrix = self._salmonella_matrix(classes)
+        mduids, itemcodes = self._mduids(df['Isolate'])
+        results = {"MDU Sample ID": mduids, "Item code": itemcodes}
+        # the genes of each drug class column of each isolate - ResMech lists the genes of every column that confers resistance, separated by ;
+        found = df[classes].astype(str).stack().astype(object) # an empty stack (no drug classes in the run) is float
+        found = found[found != '']
+        hits = matrix.loc[found.index.get_level_values(1)].to_numpy()
+        mechs = found.str.replace(',', ';')
+        detected = {}
+        for n, ab in enumerate(matrix.columns):
+            detected[ab] = mechs[hits[:, n]].groupby(level = 0, sort = False).agg(';'.join).reindex(df.index)
+        both = detected['Trimethoprim'].notna() & detected['Sulfathiazole'].notna()
+        detected['Trim-Sulpha'] = pandas.Series(
+            [';'.join(dict.fromkeys(f"{t};{s}".split(';'))) if b else numpy.nan for t, s, b in zip(detected['Trimethoprim'], detected['Sulfathiazole'], both)],
+            index = df.index, dtype = object
+        )
+        # Other is every gene found that is not reported for an antibiotic - a gene is taken off once for each antibiotic it is reported for
+        weights = matrix.sum(axis = 1)
+        other = []
+        for isolate, isodict in zip(df['Isolate'], df.to_dict(orient = 'records')):
+            taken = collections.Counter()
+            for col in classes:
+                if isodict[col] != '' and weights[col]:
+                    for gene in f"{isodict[col]}".split(','):
+                        taken[gene] += weights[col]
+            genes = []
+            for gene in [g for value in isodict.values() if isinstance(value, str) for g in value.split(',')]:
+                if gene == isolate or gene == '':
+                    continue
+                if taken[gene] > 0:
+                    taken[gene] -= 1
+                else:
+                    genes.append(gene)
+            other.append(';'.join(genes) if genes else numpy.nan)
+        detected['Other'] = pandas.Series(other, index = df.index, dtype = object)
+        for ab, genes in detected.items():
+            results[f"{ab} - ResMech"] = list(genes.fillna("None detected"))
+            if ab in ["Aminoglycosides (RMT)","Colistin", "Other"]:
+                results[f"{ab} - Interpretation"] = ''
             else:
-                result_df = result_df.append(tmpdf)
+                results[f"{ab} - Interpretation"] = list(numpy.where(genes.isna(), 'Susceptible', 'Resistant'))
         
-        return result_df[cols]
+        return pandas.DataFrame(results, index = df.index).reindex(labels = cols, axis = 'columns')
 
     def _extract_plus_isolates(self,species):
 
-        qc = self.mdu_qc_tab()
+        qc = self._qc_index()
         qc = qc[(qc['SPECIES_OBS'] == species) & (qc['TEST_QC'] == 'PASS')]
 
-        return list(qc["ISOLATE"])
+        return list(qc.index)
 
 
     def mdu_reporting_general(self, match, neg_code = True):
 
         self.logger.info(f"Applying MDU business logic {'matches' if neg_code else 'partials'}.")
-        mduidreg = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,})?')
-        reporting_df = pandas.DataFrame()
-        qc = self.mdu_qc_tab()
-        match_df = pandas.read_csv(match, sep = '\t')
-        for row in match_df.iterrows():
-            isolate = row[1]['Isolate']
-            item_code = self.assign_itemcode(f"{isolate}", mduidreg)
-            md = self.assign_mduid(f"{isolate}", mduidreg)
-            d = {"MDU sample ID": md, "Item code" : item_code}
-            qcdf = qc[qc['ISOLATE'].str.contains(f"{isolate}")]
-            exp_species = qcdf["SPECIES_EXP"].values[0]
-            obs_species = qcdf["SPECIES_OBS"].values[0]
-            if obs_species == exp_species:
-                species = exp_species
-            elif obs_species != exp_species and 'Shigella' in exp_species:
-                species = exp_species
-            else:
-                species = obs_species
-            # species = obs_species if obs_species == exp_species else obs_species
-            genes_reported, genes_not_reported = self.reporting_logic_general(
-                row=row, species=species, neg_code=neg_code
-            )
-            
-            # strip bla
-            genes_not_reported = [self.strip_bla(g) for g in genes_not_reported]
-            genes_not_reported = [g for g in genes_not_reported if g != isolate]
-            genes_reported = [self.strip_bla(g) for g in genes_reported]
-            genes_reported = [g for g in genes_reported if g != isolate]
-            d["Resistance genes (alleles) detected"] = ",".join(genes_reported)
-            d["Resistance genes (alleles) det (non-rpt)"] = ",".join(genes_not_reported)
-            if qcdf["TEST_QC"].values[0] == 'FAIL': # species not needed for MDU LIMS upload
-                d["Species_exp"] = exp_species
-            d["Species_obs"] = obs_species
-            d["Species_exp"] = exp_species
-            d['db_version'] = self.db
-            tempdf = pandas.DataFrame(d, index=[0])
-            tempdf = tempdf.set_index("MDU sample ID")
-            
-            if reporting_df.empty:
-                reporting_df = tempdf
-            else:
-                reporting_df = pandas.concat([reporting_df,tempdf])
+        cols = ['Item code','Resistance genes (alleles) detected','Resistance genes (alleles) det (non-rpt)','Species_obs', 'Species_exp', 'db_version']
+        match_df = self._read_summary(match)
+        if match_df.empty:
+            return pandas.DataFrame().reindex(labels = cols, axis = 'columns')
+        qc = self._qc_lookup(match_df['Isolate'])
+        exp_species = list(qc["SPECIES_EXP"])
+        obs_species = list(qc["SPECIES_OBS"])
+        # the expected species is used if it is what was observed or is a Shigella, otherwise the observed species
+        species = [f"{e}" if e == o or 'Shigella' in f"{e}" else f"{o}" for e, o in zip(exp_species, obs_species)]
+        mduids, itemcodes = self._mduids(match_df['Isolate'])
+        # bla is stripped once for each gene
+        stripped = {}
+        detected = []
+        not_detected = []
+        for n, (isolate, isodict, sp) in enumerate(zip(match_df['Isolate'], match_df.to_dict(orient = 'records'), species)):
+            genes_reported, genes_not_reported = self.reporting_logic_general(row = (n, isodict), species = sp, neg_code = neg_code)
+            for genes, out in [(genes_reported, detected), (genes_not_reported, not_detected)]:
+                for g in genes:
+                    if g not in stripped:
+                        stripped[g] = self.strip_bla(g)
+                out.append(",".join(stripped[g] for g in genes if stripped[g] != isolate))
+        reporting_df = pandas.DataFrame({
+            "MDU sample ID": mduids,
+            "Item code": itemcodes,
+            "Resistance genes (alleles) detected": detected,
+            "Resistance genes (alleles) det (non-rpt)": not_detected,
+            "Species_obs": obs_species,
+            "Species_exp": exp_species,
+            "db_version": self.db
+        }).set_index("MDU sample ID")
             
-        return reporting_df.reindex(labels = ['Item code','Resistance genes (alleles) detected','Resistance genes (alleles) det (non-rpt)','Species_obs', 'Species_exp', 'db_version'], axis = 'columns')
+        return reporting_df.reindex(labels = cols, axis = 'columns')
 
     
+    def _sheet_rows(self, df, index = True):
+        """
+        the rows of a sheet as lists, header first, with missing values left blank
+        """
+        if index:
+            df = df.reset_index(names = df.index.name if df.index.name is not None else '')
+        yield list(df.columns)
+        yield from df.astype(object).where(df.notna(), '').to_numpy().tolist()
+
+    def _write_xlsx(self, path, sheets):
+        """
+        write the sheets to a workbook a row at a time - xlsxwriter is in constant memory mode, so only the row being written is held in memory
+        """
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        for name, df, index in sheets:
+            worksheet = workbook.add_worksheet(name)
+            for r, row in enumerate(self._sheet_rows(df, index = index)):
+                worksheet.write_row(r, 0, row)
+        workbook.close()
+
+    def _write_table(self, path, df, index, fmt):
+        """
+        write one sheet as csv or parquet
+        """
+        if fmt == 'csv':
+            df.to_csv(path, index = index)
+            return
+        if index:
+            df = df.reset_index()
+        df.to_parquet(path, index = False)
+
+    def save_sheets(self, sheets):
+        """
+        write the sheets (name, frame and whether to keep the index) of the report in each format asked for, the formats at the same time - xlsx to one workbook, csv and parquet to a file for each sheet
+        """
+        stem = f"{self.runid}_{self.sop_name}"
+        tasks = []
+        for fmt in self.formats:
+            if fmt == 'xlsx':
+                tasks.append((self._write_xlsx, f"{stem}.xlsx", sheets))
+            else:
+                for name, df, index in sheets:
+                    tasks.append((self._write_table, f"{stem}_{re.sub(r'[^A-Za-z0-9.-]+', '_', name)}.{fmt}", df, index, fmt))
+        self.logger.info(f"Saving {', '.join(t[1] for t in tasks)}.")
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = max(len(tasks), 1)) as pool:
+                for future in [pool.submit(*task) for task in tasks]:
+                    future.result()
+        except ImportError as e:
+            self.logger.critical(f"The report could not be saved ({e}). Please install what is needed for the formats asked for or choose other formats.")
+            raise SystemExit
+
     def save_spreadsheet_general(
         self,
         passed_match,
@@ -816,23 +1117,22 @@ class MduCollate(Collate):
         
     ):
         self.logger.info(f"Saving {self.sop_name}.")
-        writer = pandas.ExcelWriter(f"{self.runid}_{self.sop_name}.xlsx", engine="xlsxwriter")
-        passed_match.to_excel(writer, sheet_name=f"{self.sop_name}")
-        passed_partials.to_excel(writer, sheet_name="Passed QC partial")
-        writer.close()
+        self.save_sheets(sheets = [(f"{self.sop_name}", passed_match, True), ("Passed QC partial", passed_partials, True)])
 
     def save_spreadsheet_interpreted(self, results):
         sheets = {"Salmonella enterica":f"{self.sop_name}-01"}
         self.logger.info(f"Saving MMS184")
-        writer = pandas.ExcelWriter(f"{self.runid}_{self.sop_name}.xlsx", engine = "xlsxwriter")
-        for result in results:
-            result[1].to_excel(writer, sheet_name = sheets[result[0]], index = False)
-        writer.close()
+        self.save_sheets(sheets = [(sheets[result[0]], result[1], False) for result in results])
 
-    def run(self):
-        if self.sop == 'general' and pathlib.Path(self.partials).exists():
-            passed_match_df = self.mdu_reporting_general(match=self.match)
-            passed_partials_df = self.mdu_reporting_general(match = self.partials)
+    def run(self, matches = None, partials = None):
+        """
+        make the report - from the matches and partials tables if they are given (by a run), otherwise from the summary files
+        """
+        matches = matches if matches is not None else self.match
+        partials = partials if partials is not None else self.partials
+        if self.sop == 'general' and (isinstance(partials, pandas.DataFrame) or pathlib.Path(partials).exists()):
+            passed_match_df = self.mdu_reporting_general(match=matches)
+            passed_partials_df = self.mdu_reporting_general(match = partials)
             self.save_spreadsheet_general(
                 passed_match_df,
                 passed_partials_df
@@ -844,7 +1144,7 @@ class MduCollate(Collate):
                 isolates = self._extract_plus_isolates(species = r)
                 if isolates != []:
                     self.logger.info(f"There are {len(isolates)} {r} in this run.")
-                    plus_df = self.mdu_reporting_salmonella(match = self.match, isolates=isolates)
+                    plus_df = self.mdu_reporting_salmonella(match = matches, isolates=isolates)
                     dfs.append((r,plus_df))
                 else:
                     self.logger.info(f"There are no {r} in this run. Collation will be skipped.")
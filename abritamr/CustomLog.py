@@ -1,4 +1,7 @@
-import logging
+import logging, logging.handlers, queue, atexit, os, contextlib
+
+LOG = "abritamr.log"
+DATEFMT = '%m/%d/%Y %I:%M:%S %p'
 
 class CustomFormatter(logging.Formatter):
     """Logging Formatter to add colors and count warning / errors"""
@@ -17,8 +20,109 @@ class CustomFormatter(logging.Formatter):
         logging.ERROR: red + format + reset,
         logging.CRITICAL: bold_red + format + reset
     }
+    # one formatter per level, made once rather than for every record
+    FORMATTERS = {level: logging.Formatter(fmt, datefmt=DATEFMT) for level, fmt in FORMATS.items()}
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt,datefmt='%m/%d/%Y %I:%M:%S %p')
-        return formatter.format(record)
\ No newline at end of file
+        formatter = self.FORMATTERS.get(record.levelno, self.FORMATTERS[logging.INFO])
+        return formatter.format(record)
+
+
+class IsolateFilter(logging.Filter):
+    """
+    Rate limit the INFO messages logged for each isolate (those logged with extra = {"isolate": ...}). The first BURST are kept, then one in every EVERY with a count of those left out. Other messages are always kept.
+    """
+    BURST = 20
+    EVERY = 100
+
+    def __init__(self):
+        super().__init__()
+        self.seen = 0
+
+    def filter(self, record):
+        if not hasattr(record, "isolate") or record.levelno > logging.INFO:
+            return True
+        self.seen += 1
+        if self.seen <= self.BURST:
+            return True
+        if (self.seen - self.BURST) % self.EVERY == 0:
+            record.msg = f"{record.msg} ({self.EVERY - 1} similar messages not shown)"
+            return True
+        return False
+
+
+# the handlers in use - attached once to the abritamr logger, the listener writes records from the queue on a background thread
+_LOGGING = {}
+
+def _child_handlers():
+    """
+    a forked worker has no listener thread so writes to the handlers directly
+    """
+    if "listener" in _LOGGING:
+        logger = logging.getLogger("abritamr")
+        logger.removeHandler(_LOGGING["queue_handler"])
+        for handler in _LOGGING["listener"].handlers:
+            logger.addHandler(handler)
+        _LOGGING.pop("listener")
+        _LOGGING.pop("queue_handler")
+
+os.register_at_fork(after_in_child=_child_handlers)
+
+def stop_logging():
+    """
+    write any records left on the queue and remove the handlers
+    """
+    if "listener" in _LOGGING:
+        _LOGGING["listener"].stop()
+        logger = logging.getLogger("abritamr")
+        logger.removeHandler(_LOGGING["queue_handler"])
+        for handler in _LOGGING["listener"].handlers:
+            handler.close()
+        _LOGGING.clear()
+
+atexit.register(stop_logging)
+
+@contextlib.contextmanager
+def paused_logging():
+    """
+    stop the listener thread while the block runs, so that worker processes can be forked with no other threads running (records logged meanwhile wait on the queue), and start it again after
+    """
+    listener = _LOGGING.get("listener")
+    if listener is None:
+        yield
+        return
+    listener.stop()
+    try:
+        yield
+    finally:
+        listener.start()
+
+def setup_logging(path=LOG, level=logging.INFO):
+    """
+    attach a queue to the abritamr logger with a console handler and a file handler for path behind it. Calling it again with the same path does nothing, a new path replaces the handlers.
+    """
+    if _LOGGING.get("path") == f"{path}":
+        return logging.getLogger("abritamr")
+    stop_logging()
+    ch = logging.StreamHandler()
+    ch.setFormatter(CustomFormatter())
+    fh = logging.FileHandler(path)
+    fh.setFormatter(logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt=DATEFMT))
+    q = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(q)
+    queue_handler.addFilter(IsolateFilter())
+    listener = logging.handlers.QueueListener(q, ch, fh)
+    logger = logging.getLogger("abritamr")
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    listener.start()
+    _LOGGING.update({"path": f"{path}", "queue_handler": queue_handler, "listener": listener})
+    return logger
+
+def get_logger(name):
+    """
+    the logger for a module of abritamr, logging is set up with the default log file if it has not been already
+    """
+    if not _LOGGING:
+        setup_logging()
+    return logging.getLogger(name)
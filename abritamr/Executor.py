@@ -0,0 +1,86 @@
+import asyncio, collections, time, pathlib
+from abritamr.CustomLog import get_logger
+
+# a command to run - name is the sample (or group of samples) it is for, err the file its stderr is written to and size how big its input is (used to start the longest jobs first). Jobs of the same group (eg organism) and of a similar size are run together. {threads} in cmd is replaced with the number of threads the job is given.
+Job = collections.namedtuple('Job', ['name', 'cmd', 'err', 'size', 'group'], defaults = [0, ''])
+# the outcome of a job - returncode is that of the last attempt and wall the seconds taken over all attempts
+Result = collections.namedtuple('Result', ['name', 'returncode', 'wall', 'attempts'])
+
+
+class Executor:
+    """
+    Run each job as its own subprocess using at most jobs threads at a time. Jobs are started largest first, with jobs of a similar size (within a factor of two) started a group at a time (the group with the most work first), and each job is given threads in proportion to its share of the work not yet started - so the largest jobs get the most threads - while a thread is left for the jobs still waiting.
+    A job that fails is retried up to retries times, and a failure does not stop the other jobs.
+    """
+    MAX_THREADS = 8 # amrfinder gains little from more threads than this
+
+    def __init__(self, jobs, retries = 1):
+
+        self.logger = get_logger(__name__)
+        self.jobs = max(int(jobs), 1)
+        self.retries = int(retries)
+
+    def _threads(self, job, waiting, free):
+        """
+        the threads to give job when it is started with free threads and the jobs in waiting still to start
+        """
+        total = job.size + sum(j.size for j in waiting)
+        share = round(self.jobs * job.size / total) if total else self.jobs // (len(waiting) + 1)
+        return max(1, min(share, free - 1 if waiting else free, self.MAX_THREADS))
+
+    async def _attempt(self, job, threads):
+        """
+        run the command once with its stderr written to the job's err file, return the exit code
+        """
+        pathlib.Path(job.err).parent.mkdir(parents = True, exist_ok = True)
+        cmd = [f"{c}".replace("{threads}", f"{threads}") for c in job.cmd]
+        with open(job.err, "w") as err:
+            try:
+                p = await asyncio.create_subprocess_exec(*cmd, stdout = asyncio.subprocess.DEVNULL, stderr = err)
+            except OSError as e:
+                err.write(f"{e}\n")
+                return 127
+            return await p.wait()
+
+    async def _run_job(self, job, threads, on_done):
+
+        start = time.monotonic()
+        for attempt in range(1, self.retries + 2):
+            returncode = await self._attempt(job, threads)
+            if returncode == 0:
+                break
+            self.logger.warning(f"{job.name} failed with exit code {returncode} (attempt {attempt}), see {job.err}")
+        result = Result(job.name, returncode, time.monotonic() - start, attempt)
+        if returncode == 0:
+            self.logger.info(f"{job.name} completed in {result.wall:.1f}s with {threads} threads", extra = {"isolate": job.name})
+        if on_done is not None:
+            on_done(result)
+        return result
+
+    async def _run_all(self, jobs, on_done):
+
+        totals = collections.Counter()
+        for job in jobs:
+            totals[job.group] += job.size
+        waiting = sorted(jobs, key = lambda j: (int(j.size).bit_length(), totals[j.group], j.group, j.size), reverse = True)
+        free = self.jobs
+        running = {}
+        results = []
+        while waiting or running:
+            while waiting and free > 0:
+                job = waiting.pop(0)
+                threads = self._threads(job = job, waiting = waiting, free = free)
+                free -= threads
+                running[asyncio.create_task(self._run_job(job = job, threads = threads, on_done = on_done))] = threads
+            finished, pending = await asyncio.wait(running, return_when = asyncio.FIRST_COMPLETED)
+            for task in finished:
+                free += running.pop(task)
+                results.append(task.result())
+        return results
+
+    def run(self, jobs, on_done = None):
+        """
+        run the jobs and return a Result for each, keyed on the job name. on_done is called with the Result of each job as it finishes and should return quickly
+        """
+        results = asyncio.run(self._run_all(jobs, on_done))
+        return {r.name: r for r in results}
@@ -0,0 +1,76 @@
+import sqlite3, time, pathlib
+from abritamr.Cache import sha256sum
+
+
+class Ledger:
+    """
+    A record, kept in sqlite in the output directory, of the state of each sample of a batch - so that a batch that is stopped part way can be resumed.
+    A sample is only complete if amrfinder exited without error and its amrfinder.out still has the checksum recorded when it finished.
+    """
+    NAME = "abritamr_ledger.sqlite3"
+
+    def __init__(self, path = NAME):
+
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS samples (
+                sample TEXT PRIMARY KEY,
+                assembly TEXT,
+                settings TEXT,
+                state TEXT,
+                started REAL,
+                finished REAL,
+                returncode INTEGER,
+                checksum TEXT
+            )"""
+        )
+        self.con.commit()
+
+    def _output(self, sample):
+
+        return pathlib.Path(f"{sample}/amrfinder.out")
+
+    def complete(self, samples, settings):
+        """
+        the samples that finished in an earlier run with the same assembly and settings (a dict of sample to its settings), and whose output is unchanged since
+        """
+        rows = {r[0]: r[1:] for r in self.con.execute("SELECT sample, assembly, settings, checksum FROM samples WHERE state = 'done'")}
+        complete = []
+        for sample, assembly in samples:
+            if sample not in rows or rows[sample][:2] != (assembly, settings[sample]):
+                continue
+            out = self._output(sample)
+            if out.exists() and sha256sum(out) == rows[sample][2]:
+                complete.append(sample)
+        return complete
+
+    def plan(self, samples, settings):
+        """
+        record samples as queued to run, with their settings (a dict of sample to its settings)
+        """
+        with self.con:
+            self.con.executemany(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, 'queued', NULL, NULL, NULL, NULL)",
+                [(sample, assembly, settings[sample]) for sample, assembly in samples]
+            )
+
+    def finish(self, sample, returncode, wall = 0):
+        """
+        record the outcome of amrfinder for a sample - with the checksum of its output if it succeeded. A sample without an output is recorded as failed. Returns True if the sample is done
+        """
+        finished = time.time()
+        out = self._output(sample)
+        done = returncode == 0 and out.exists()
+        checksum = sha256sum(out) if done else None
+        with self.con:
+            self.con.execute(
+                "UPDATE samples SET state = ?, started = ?, finished = ?, returncode = ?, checksum = ? WHERE sample = ?",
+                ("done" if done else "failed", finished - wall, finished, returncode, checksum, sample)
+            )
+        return done
+
+    def close(self):
+
+        self.con.close()
@@ -0,0 +1,96 @@
+import sys, time, json, os, datetime
+
+
+class Progress:
+    """
+    Counts of the samples of a batch as they finish - shown as a progress line (with the samples completed per minute and an estimate of the time left) when stderr is a terminal, and written as JSON to path for other tools to poll.
+    Samples found in the cache or completed in an earlier run are counted as skipped and are not used for the rate.
+    """
+    NAME = "abritamr_progress.json"
+    EVERY = 1.0 # seconds between updates of the progress line and file
+
+    def __init__(self, total, path = NAME, stream = None):
+
+        self.total = total
+        self.path = path
+        self.stream = stream if stream is not None else sys.stderr
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.last = 0
+        self.finished = False
+        self._update(force = True)
+
+    def complete(self, sample, skipped = False):
+
+        self.completed += 1
+        self.skipped += skipped
+        self._update()
+
+    def fail(self, sample):
+
+        self.failed += 1
+        self._update()
+
+    def _rate(self):
+        """
+        samples run per minute so far
+        """
+        minutes = (time.monotonic() - self.start) / 60
+        return (self.completed - self.skipped) / minutes if minutes > 0 else 0.0
+
+    def _eta(self):
+        """
+        seconds until the batch is expected to finish, None until a sample has been run
+        """
+        rate = self._rate()
+        return round((self.total - self.completed - self.failed) / rate * 60) if rate > 0 else None
+
+    def state(self):
+
+        return {
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "remaining": self.total - self.completed - self.failed,
+            "samples_per_minute": round(self._rate(), 2),
+            "eta_seconds": 0 if self.finished else self._eta(),
+            "elapsed_seconds": round(time.monotonic() - self.start),
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec = "seconds"),
+            "updated": datetime.datetime.now().isoformat(timespec = "seconds"),
+            "finished": self.finished,
+        }
+
+    def line(self, state):
+
+        eta = state["eta_seconds"]
+        eta = datetime.timedelta(seconds = eta) if eta is not None else "-"
+        return f"{state['completed']}/{state['total']} samples complete, {state['failed']} failed, {state['samples_per_minute']:.1f} samples/min, ETA {eta}"
+
+    def _update(self, force = False):
+        """
+        write the progress file (swapped into place so that a reader never sees part of it) and redraw the progress line, at most every EVERY seconds unless forced
+        """
+        now = time.monotonic()
+        if not force and now - self.last < self.EVERY:
+            return
+        self.last = now
+        state = self.state()
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent = 2)
+        os.replace(tmp, self.path)
+        if self.stream.isatty():
+            self.stream.write(f"\r\033[K{self.line(state)}")
+            self.stream.flush()
+
+    def finish(self):
+
+        self.finished = True
+        self._update(force = True)
+        if self.stream.isatty():
+            self.stream.write("\n")
+            self.stream.flush()
@@ -0,0 +1,268 @@
+import pandas, numpy, pathlib, json, os, logging, shutil, tempfile
+from abritamr.version import db, __version__
+from abritamr.Cache import cache_dir, sha256sum
+
+logger = logging.getLogger(__name__)
+
+# the columns of refgenes that are needed for collation - these are compiled into the snapshot
+SNAPSHOT_COLUMNS = [
+    "allele",
+    "gene_family",
+    "refseq_protein_accession",
+    "refseq_nucleotide_accession",
+    "genbank_protein_accession",
+    "genbank_nucleotide_accession",
+    "enhanced_subclass",
+]
+
+# refgenes tables already loaded in this process - keyed on the path of the csv
+_LOADED = {}
+
+# the methods amrfinder reports for protein searches - the resolution table has an entry for each of these with every catalog entry
+RESOLUTION_METHODS = ["ALLELEX", "EXACTX", "BLASTX", "PARTIALX", "PARTIAL_CONTIG_ENDX", "INTERNAL_STOPX", "HMMX"]
+POINT_METHODS = ["POINTX"]
+# the arrays of the resolution table in a snapshot - the sorted keys, the distinct drug classes and the drug class and name of each key
+RESOLUTION_PARTS = ["keys", "classes", "class_codes", "names"]
+# resolution tables already memory mapped in this process - keyed on the snapshot they are in
+_RESOLUTIONS = {}
+
+def _read_csv(path):
+
+    reftab = pandas.read_csv(path)
+    reftab = reftab.fillna("-")
+    return reftab
+
+def _snapshot_path(digest):
+
+    return cache_dir() / "refgenes" / f"{digest[:16]}_{db}"
+
+def _build_snapshot(path, digest, snapshot):
+    """
+    parse the csv and save each needed column as a .npy array - written to a temporary directory first so a partial snapshot is never used
+    """
+    logger.info(f"Compiling {path} to {snapshot}")
+    reftab = _read_csv(path)
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    tmp = pathlib.Path(tempfile.mkdtemp(dir=snapshot.parent, prefix=".tmp_"))
+    try:
+        for col in SNAPSHOT_COLUMNS:
+            numpy.save(tmp / f"{col}.npy", numpy.array(reftab[col].astype(str).tolist(), dtype=str))
+        for part, values in zip(RESOLUTION_PARTS, build_resolution(reftab)):
+            numpy.save(tmp / f"resolution_{part}.npy", values)
+        with open(tmp / "meta.json", "w") as j:
+            json.dump({"sha256": digest, "db": db, "version": __version__, "columns": SNAPSHOT_COLUMNS, "rows": len(reftab)}, j)
+        os.replace(tmp, snapshot)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not (snapshot / "meta.json").exists():
+            raise
+
+def _load_snapshot(snapshot):
+    """
+    read the compiled columns
+    """
+    return pandas.DataFrame({col: numpy.load(snapshot / f"{col}.npy") for col in SNAPSHOT_COLUMNS})
+
+def _snapshot_ok(snapshot, digest):
+
+    meta = snapshot / "meta.json"
+    if not meta.exists():
+        return False
+    with open(meta, "r") as j:
+        m = json.load(j)
+    return m["sha256"] == digest and m["db"] == db and m.get("version") == __version__ and m["columns"] == SNAPSHOT_COLUMNS
+
+def load_reftab(path):
+    """
+    return the refgenes table for path. The csv is compiled once into a columnar snapshot (keyed on the content of the csv and the db version), with the resolution table of every hit, and that snapshot is loaded once per process. A changed csv (or abritamr version) is picked up and recompiled.
+    """
+    path = pathlib.Path(path)
+    stat = path.stat()
+    sig = (stat.st_mtime_ns, stat.st_size)
+    if path in _LOADED and _LOADED[path][0] == sig:
+        return _LOADED[path][1]
+    
+    digest = sha256sum(path)
+    snapshot = _snapshot_path(digest)
+    try:
+        if not _snapshot_ok(snapshot, digest):
+            _build_snapshot(path, digest, snapshot)
+        reftab = _load_snapshot(snapshot)
+        reftab.attrs["snapshot"] = str(snapshot)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not use a compiled snapshot of {path} ({e}). The csv will be used instead.")
+        reftab = _read_csv(path)[SNAPSHOT_COLUMNS]
+    reftab.attrs["sha256"] = digest
+    _LOADED[path] = (sig, reftab)
+    return reftab
+
+
+class RefGeneIndex:
+    """
+    Hash indexes over the refgenes catalog - so that each amrfinder hit can be resolved without scanning the whole table.
+    Each index maps a value to the first row of the catalog that holds it, which is the row a boolean mask over the table would return first.
+    """
+
+    INDEXED = [
+        "allele",
+        "gene_family",
+        "refseq_protein_accession",
+        "refseq_nucleotide_accession",
+        "genbank_protein_accession",
+        "genbank_nucleotide_accession",
+    ]
+    FALLBACK = [
+        "genbank_protein_accession",
+        "refseq_nucleotide_accession",
+        "genbank_nucleotide_accession",
+    ]
+
+    def __init__(self, reftab):
+
+        self.digest = reftab.attrs.get("sha256") # only known for a table from load_reftab
+        self.snapshot = reftab.attrs.get("snapshot") # only known for a table loaded from a snapshot
+        self.allele = reftab["allele"].tolist()
+        self.gene_family = reftab["gene_family"].tolist()
+        self.enhanced_subclass = reftab["enhanced_subclass"].tolist()
+        self.indexes = {col: self._index(reftab[col].tolist()) for col in self.INDEXED}
+
+    def _index(self, values):
+        """
+        map each value to the position of its first occurrence - empty cells never match in the catalog so are left out
+        """
+        idx = {}
+        for pos, value in enumerate(values):
+            if not pandas.isna(value):
+                idx.setdefault(value, pos)
+        return idx
+
+    def contains(self, colname, value):
+
+        return value in self.indexes[colname]
+
+    def first(self, colname, value):
+        """
+        return the row of the first catalog entry with value in colname, or None if there is none
+        """
+        return self.indexes[colname].get(value)
+
+    def _first_fallback(self, value):
+        """
+        look through the fallback accession columns in order, return the first row found
+        """
+        for col in self.FALLBACK:
+            pos = self.first(col, value)
+            if pos is not None:
+                return pos
+        return None
+
+    def drugclass(self, colname, gene_id):
+        """
+        the enhanced subclass for gene_id in colname, falling back on the genbank and nucleotide accessions and then Unknown
+        """
+        pos = self.first(colname, gene_id)
+        if pos is None:
+            pos = self._first_fallback(gene_id)
+        return self.enhanced_subclass[pos] if pos is not None else "Unknown"
+
+    def gene_name(self, protein, pointn=False):
+        """
+        the allele (or gene family if there is no allele) for a protein or nucleotide accession
+        """
+        suff = f"_POINTN" if pointn else ""
+        protein = protein.split(":")[0] if pointn else protein
+        col = "refseq_nucleotide_accession" if pointn else "refseq_protein_accession"
+        pos = self.first(col, protein)
+        if pos is not None:
+            if self.allele[pos] != "-":
+                return f"{self.allele[pos]}{suff}"
+            return self.gene_family[pos]
+        pos = self._first_fallback(protein)
+        if pos is not None:
+            return self.gene_family[pos]
+
+    def resolve(self, symbol, accession, method, pointn=False):
+        """
+        the drug class and name to report for a hit with gene symbol, accession of closest sequence and method from amrfinder
+        """
+        if self.contains("allele", symbol) and "POINT" not in method:
+            drugclass = self.drugclass(colname="allele", gene_id=symbol)
+            drugname = self.gene_name(protein=accession, pointn=pointn)
+        elif self.contains("allele", symbol) and "POINT" in method:
+            drugclass = self.drugclass(colname="allele", gene_id=symbol)
+            drugname = symbol
+        elif self.contains("gene_family", symbol):
+            drugclass = self.drugclass(colname="refseq_protein_accession", gene_id=accession)
+            drugname = f"{self.gene_name(protein=accession)}*" if not method in ["EXACTX", "ALLELEX"] else f"{self.gene_name(protein=accession)}"
+        elif self.contains("refseq_protein_accession", accession):
+            drugclass = self.drugclass(colname="refseq_protein_accession", gene_id=accession)
+            drugname = self.bifunctional_name(protein=accession)
+        else:
+            drugname = symbol
+            drugclass = "Unknown"
+
+        return drugclass, drugname
+
+    def bifunctional_name(self, protein):
+        """
+        the joint name (gene family) of a bifunctional gene
+        """
+        pos = self.first("refseq_protein_accession", protein)
+        if pos is None:
+            raise IndexError(f"{protein} is not in the refgenes catalog")
+        return self.gene_family[pos]
+
+
+def build_resolution(reftab):
+    """
+    resolve the gene symbol and accession that amrfinder reports for every catalog entry (with each method) to the drug class and name abritamr will report. Returned as the arrays of RESOLUTION_PARTS, with the keys (Gene symbol, Accession of closest sequence and Method joined by tabs) sorted so that they can be searched
+    """
+    refindex = RefGeneIndex(reftab)
+    resolution = {}
+    for allele, family, protein, subtype in zip(reftab["allele"], reftab["gene_family"], reftab["refseq_protein_accession"], reftab["subtype"]):
+        if protein == "-":
+            continue
+        symbol = allele if allele != "-" else family
+        for method in POINT_METHODS if subtype == "POINT" else RESOLUTION_METHODS:
+            key = f"{symbol}\t{protein}\t{method}"
+            if key not in resolution:
+                resolution[key] = refindex.resolve(symbol=symbol, accession=protein, method=method)
+    # a hit that can not be named is left to the slow path
+    resolution = {k: v for k, v in resolution.items() if v[1] is not None}
+    keys = sorted(resolution)
+    classes, codes = numpy.unique(numpy.array([resolution[k][0] for k in keys], dtype=str), return_inverse=True)
+    return numpy.array(keys, dtype=str), classes, codes.astype(numpy.int32), numpy.array([resolution[k][1] for k in keys], dtype=str)
+
+def load_resolution(snapshot):
+    """
+    memory map the resolution table of a snapshot - None if there is no snapshot or its table can not be read
+    """
+    if snapshot is None:
+        return None
+    snapshot = pathlib.Path(snapshot)
+    if snapshot not in _RESOLUTIONS:
+        try:
+            _RESOLUTIONS[snapshot] = [numpy.load(snapshot / f"resolution_{part}.npy", mmap_mode="r") for part in RESOLUTION_PARTS]
+        except (OSError, ValueError) as e:
+            logger.warning(f"The resolution table in {snapshot} could not be read ({e}). Hits will be resolved from the refgenes catalog.")
+            _RESOLUTIONS[snapshot] = None
+    return _RESOLUTIONS[snapshot]
+
+def lookup_resolution(resolution, keys):
+    """
+    the (drug class, name) of each (Gene symbol, Accession of closest sequence, Method) in keys from a resolution table, found with one search of the sorted keys - None for a key that is not in the table
+    """
+    found = [None] * len(keys)
+    wanted = [n for n, key in enumerate(keys) if all(isinstance(k, str) for k in key)]
+    table, classes, codes, names = resolution
+    if not wanted or not len(table):
+        return found
+    query = numpy.array(["\t".join(keys[n]) for n in wanted], dtype=str)
+    pos = numpy.minimum(numpy.searchsorted(table, query), len(table) - 1)
+    hit = (table[pos] == query).tolist()
+    drugclass = classes[codes[pos]].tolist()
+    drugname = names[pos].tolist()
+    for n, h, c, d in zip(wanted, hit, drugclass, drugname):
+        if h:
+            found[n] = (c, d)
+    return found
@@ -0,0 +1,83 @@
+import json, pathlib, re, collections
+from abritamr.CustomLog import get_logger
+
+RULES = pathlib.Path(__file__).parent / "reporting_rules.json"
+FORMAT = 1 # the format of rules file that can be read
+
+# what is done with the genes of a drug class for a species - reported or not, and if reported only those that match genes and do not match except
+Decision = collections.namedtuple('Decision', ['report', 'genes', 'exclude'])
+NOT_REPORTED = Decision(False, None, None)
+
+
+class ReportingRules:
+    """
+    The rules for which genes are reportable under an sop, read from a versioned json file.
+    The rules for a drug class are in order and the first that applies to the species decides - a rule applies if it has no species or genus, or the species or its genus is listed. A drug class without rules is not reported.
+    The rules are compiled (patterns and all) when read, and the decision for each species and drug class is kept the first time it is made, so deciding on a gene is a table lookup.
+    """
+
+    def __init__(self, path = RULES, sop = "general"):
+
+        self.logger = get_logger(__name__)
+        self.path = path
+        try:
+            with open(path) as j:
+                rules = json.load(j)
+            if rules.get("format") != FORMAT:
+                raise ValueError(f"format {rules.get('format')} can not be read, format {FORMAT} is needed")
+            version = rules["version"]
+            rules = rules["sops"][sop]
+            self.negative_codes = rules["negative_codes"]
+            self.negative_codes["Other"]
+            self.classes = {col: [self._compile(rule) for rule in col_rules] for col, col_rules in rules["classes"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+            self.logger.critical(f"The reporting rules for {sop} could not be read from {path} ({e}). Please check the rules file and try again.")
+            raise SystemExit
+        self.logger.info(f"Using version {version} of the reporting rules for {sop} from {path}")
+        self.table = {}
+
+    def _compile(self, rule):
+        """
+        the species and genera a rule applies to and its Decision
+        """
+        decision = Decision(
+            bool(rule["report"]),
+            re.compile(rule["genes"]) if "genes" in rule else None,
+            re.compile(rule["except"]) if "except" in rule else None
+        )
+        return frozenset(rule.get("species", [])), frozenset(rule.get("genus", [])), decision
+
+    def _genus(self, species):
+
+        return species.split()[0] if species.split() else ''
+
+    def decision(self, species, col):
+        """
+        the Decision for genes of the drug class col in species
+        """
+        key = (species, col)
+        if key not in self.table:
+            genus = self._genus(species)
+            self.table[key] = NOT_REPORTED
+            for in_species, in_genus, decision in self.classes.get(col, []):
+                if (not in_species and not in_genus) or species in in_species or genus in in_genus:
+                    self.table[key] = decision
+                    break
+        return self.table[key]
+
+    def reportable(self, col, gene, species):
+        """
+        True if gene, found in the drug class col, is reportable for species
+        """
+        decision = self.decision(species = species, col = col)
+        if not decision.report:
+            return False
+        if decision.genes is not None and decision.genes.search(gene) is None:
+            return False
+        return decision.exclude is None or decision.exclude.search(gene) is None
+
+    def negative_code(self, species):
+        """
+        the code reported for species when none of its genes are reportable
+        """
+        return self.negative_codes.get(self._genus(species), self.negative_codes["Other"])
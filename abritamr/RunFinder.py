@@ -1,25 +1,25 @@
-import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections, re
+import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections, re, tempfile, shutil
 from abritamr.version import db
-from abritamr.CustomLog import CustomFormatter
+from abritamr.CustomLog import get_logger
+from abritamr.Executor import Executor, Job
+from abritamr.Cache import FileCache, make_key, sha256sum, link_or_copy
+from abritamr.Ledger import Ledger
+from abritamr.StageDB import StagedDB, prewarm
+from abritamr.Progress import Progress
 
 
 class RunFinder(object):
     """
     A class to run amrfinderplus
     """
+    failed = [] # samples of a batch that amrfinder failed for
+    cache = None # a FileCache of amrfinder outputs keyed on the assembly and the amrfinder settings, None if not caching
+    ledger = None # the Ledger of the state of each sample of a batch
+    progress = None # the Progress of a batch, shown as it runs
+    MULTIPLEX_TAG = re.compile(r"abritamr(?P<idx>[0-9]+)_") # put in front of each contig name in a multiplexed fasta to mark which sample it is from
     def __init__(self, args):
         
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.db = db
         self.organism = args.organism
         self.input = args.input
@@ -28,16 +28,281 @@ class RunFinder(object):
         self.prefix = args.prefix
         self.identity = args.identity
         self.amrfinder_db = args.amrfinder_db
+        self.source_db = args.amrfinder_db # amrfinder_db is changed to the staged copy while a batch is run
+        self.stage_db = args.stage_db
+        self.prewarm_db = args.prewarm_db
+        self.stream = args.stream
+        self.no_cache = args.no_cache
+        self.cache_size = args.cache_size
+        self.retries = args.retries
+        self.multiplex = int(args.multiplex)
+        self.resume = args.resume
+        self._shas = {}
+        self.organisms = {} # the organism given for a sample in the third column of the batch input file
+        if not args.no_cache:
+            self.cache = FileCache("amrfinder", int(args.cache_size) * 1024 * 1024)
 
-    def _batch_cmd(self):
+    def _get_samples(self):
         """
-        generate cmd with parallel
+        the sample id and assembly of each row of the batch input file - the organism of each sample, if given, is kept in organisms
         """
-        org = f"--organism {self.organism}" if self.organism != '' else ''
-        d = f" -d {self.amrfinder_db}" if self.amrfinder_db != '' else ''
-        _id = f" --ident_min {self.identity} " if self.identity != '' else ''
-        cmd = f"parallel -j {self.jobs} --colsep '\\t' 'mkdir -p {{1}} && amrfinder -n {{2}} -o {{1}}/amrfinder.out --plus {org} --threads 1{d}{_id}' :::: {self.input}"
+        tab = pandas.read_csv(self.input, sep = '\t', header = None, names = [0, 1, 2], dtype = str).fillna('')
+        self.organisms = {sample: organism for sample, organism in zip(tab[0], tab[2]) if organism != ''}
+        return list(zip(tab[0], tab[1]))
+
+    def _organism(self, sample):
+        """
+        the organism for a sample - from the batch input file, or --species for the run
+        """
+        return self.organisms.get(sample, self.organism)
+
+    def _sample_cmd(self, sample, assembly, threads = 1, organism = None):
+        """
+        generate the amrfinder command for one sample of a batch
+        """
+        organism = self.organism if organism is None else organism
+        cmd = ["amrfinder", "-n", f"{assembly}", "-o", f"{sample}/amrfinder.out", "--plus", "--threads", f"{threads}"]
+        if organism != '':
+            cmd.extend(["--organism", f"{organism}"])
+        if self.amrfinder_db != '':
+            cmd.extend(["-d", f"{self.amrfinder_db}"])
+        if self.identity != '':
+            cmd.extend(["--ident_min", f"{self.identity}"])
         return cmd
+
+    def _amrfinder_version(self):
+        """
+        the version of amrfinder that will be run, None if it can not be found
+        """
+        try:
+            p = subprocess.run(["amrfinder", "--version"], capture_output = True, encoding = "utf-8")
+        except OSError:
+            return None
+        return p.stdout.strip() if p.returncode == 0 and p.stdout.strip() else None
+
+    def _db_version(self):
+        """
+        the version of the amrfinder DB in use, from its version.txt
+        """
+        version = pathlib.Path(f"{self.source_db}") / "version.txt"
+        if self.source_db and version.exists():
+            return version.read_text().strip()
+        return self.source_db
+
+    def _result_key(self, assembly, version, organism):
+        """
+        the cache key for the amrfinder output of assembly - changes with the content of the assembly, the amrfinder and DB versions and the settings that change the output
+        """
+        return make_key(self._assembly_sha(assembly), version, self._db_version(), organism, self.identity)
+
+    def _assembly_sha(self, assembly):
+        """
+        the sha256 of an assembly - each is only read once in a run
+        """
+        if assembly not in self._shas:
+            self._shas[assembly] = sha256sum(assembly)
+        return self._shas[assembly]
+
+    def _deduplicate(self, samples):
+        """
+        find samples whose assemblies have the same content (and the same organism) - only the first sample of each is run. Return the samples to run and the other samples for each of them.
+        """
+        first = {}
+        duplicates = {}
+        unique = []
+        for sample, assembly in samples:
+            sha = (self._assembly_sha(assembly), self._organism(sample))
+            if sha not in first:
+                first[sha] = sample
+                unique.append((sample, assembly))
+            elif sample != first[sha] and sample not in duplicates.setdefault(first[sha], []):
+                duplicates[first[sha]].append(sample)
+        n = sum(len(d) for d in duplicates.values())
+        if n:
+            self.logger.info(f"{n} samples have the same assembly as another sample in this batch - amrfinder will be run for {len(unique)} unique assemblies and the results shared.")
+        return unique, duplicates
+
+    def _fan_out(self, sample, duplicates):
+        """
+        give each duplicate of sample a copy of its amrfinder output
+        """
+        for dup in duplicates:
+            pathlib.Path(dup).mkdir(parents = True, exist_ok = True)
+            link_or_copy(f"{sample}/amrfinder.out", f"{dup}/amrfinder.out")
+            if pathlib.Path(f"{sample}/amrfinder.err").exists():
+                shutil.copyfile(f"{sample}/amrfinder.err", f"{dup}/amrfinder.err")
+
+    def _from_cache(self, samples, on_done = None):
+        """
+        link the cached amrfinder output into each sample directory where there is one, return the samples still to run and the cache key of each of them. on_done is called with the name of each sample found
+        """
+        version = self._amrfinder_version() if self.cache else None
+        if version is None:
+            return samples, {}
+        keys = {}
+        for sample, assembly in samples:
+            key = self._result_key(assembly = assembly, version = version, organism = self._organism(sample))
+            cached = self.cache.get(key)
+            if cached is None:
+                keys[sample] = key
+            else:
+                pathlib.Path(sample).mkdir(parents = True, exist_ok = True)
+                link_or_copy(cached, f"{sample}/amrfinder.out")
+                if on_done is not None:
+                    on_done(sample)
+        self.logger.info(f"amrfinder cache: {self.cache.hits} samples found and {self.cache.misses} to run.")
+        return [(sample, assembly) for sample, assembly in samples if sample in keys], keys
+
+    def _to_cache(self, keys):
+        """
+        save the amrfinder output of each sample that was run and did not fail, then keep the cache within its size
+        """
+        for sample, key in keys.items():
+            out = pathlib.Path(f"{sample}/amrfinder.out")
+            if sample not in self.failed and out.exists():
+                self.cache.put_file(key, out)
+        removed = self.cache.evict()
+        if removed:
+            self.logger.info(f"Removed {removed} entries from the amrfinder cache.")
+
+    def _clear_outputs(self, samples):
+        """
+        remove old amrfinder output before a sample is run - it may be a hard link to a cached output, which amrfinder would otherwise write over
+        """
+        for sample, assembly in samples:
+            pathlib.Path(f"{sample}/amrfinder.out").unlink(missing_ok = True)
+
+    def _batch_cmd(self, samples = None):
+        """
+        generate a job for each sample in the batch, or for each of samples if given - the executor sets the threads for each
+        """
+        samples = self._get_samples() if samples is None else samples
+        return [
+            Job(sample, self._sample_cmd(sample = sample, assembly = assembly, threads = "{threads}", organism = self._organism(sample)), f"{sample}/amrfinder.err", os.path.getsize(assembly), self._organism(sample)) 
+            for sample, assembly in samples
+            ]
+
+    def _count_bases(self, assembly):
+        """
+        the number of bases in a fasta file
+        """
+        bases = 0
+        with open(assembly, "rb") as f:
+            for line in f:
+                if not line.startswith(b">"):
+                    bases += len(line.strip())
+        return bases
+
+    def _plan_multiplex(self, samples):
+        """
+        put assemblies smaller than the multiplex size into groups of up to that many bases, in input order - each group is of one organism. Return the groups and the samples to run on their own.
+        """
+        if not self.multiplex:
+            return [], samples
+        groups = []
+        singles = []
+        open_groups = {} # the group being filled for each organism, and its size
+        for sample, assembly in samples:
+            size = self._count_bases(assembly)
+            if size >= self.multiplex:
+                singles.append((sample, assembly))
+                continue
+            organism = self._organism(sample)
+            group, group_size = open_groups.get(organism, ([], 0))
+            if group and group_size + size > self.multiplex:
+                groups.append(group)
+                group, group_size = [], 0
+            open_groups[organism] = (group + [(sample, assembly)], group_size + size)
+        groups.extend(group for group, group_size in open_groups.values())
+        singles.extend(g[0] for g in groups if len(g) == 1)
+        return [g for g in groups if len(g) > 1], singles
+
+    def _multiplex_job(self, path, group):
+        """
+        write the assemblies of a group into one fasta, with each contig name tagged with the position of its sample in the group, and return the job to run amrfinder on it
+        """
+        path.mkdir(parents = True, exist_ok = True)
+        with open(path / "input.fa", "w") as out:
+            for idx, (sample, assembly) in enumerate(group):
+                line = "\n"
+                with open(assembly, "r") as fasta:
+                    for line in fasta:
+                        out.write(f">abritamr{idx}_{line[1:]}" if line.startswith(">") else line)
+                if not line.endswith("\n"):
+                    out.write("\n")
+        organism = self._organism(group[0][0])
+        return Job(f"{path}", self._sample_cmd(sample = f"{path}", assembly = f"{path / 'input.fa'}", threads = "{threads}", organism = organism), f"{path}/amrfinder.err", os.path.getsize(path / "input.fa"), organism)
+
+    def _demultiplex(self, path, group):
+        """
+        split the amrfinder output of a group into the output of each sample, with the tags taken off the contig names. Return the samples.
+        """
+        path = pathlib.Path(path)
+        with open(path / "amrfinder.out", "r") as f:
+            lines = f.read().splitlines()
+        col = lines[0].split("\t").index("Contig id")
+        rows = {idx: [] for idx in range(len(group))}
+        for line in lines[1:]:
+            fields = line.split("\t")
+            m = self.MULTIPLEX_TAG.match(fields[col])
+            fields[col] = fields[col][m.end():]
+            rows[int(m.group("idx"))].append("\t".join(fields))
+        for idx, (sample, assembly) in enumerate(group):
+            pathlib.Path(sample).mkdir(parents = True, exist_ok = True)
+            with open(f"{sample}/amrfinder.out", "w") as out:
+                out.write("\n".join([lines[0]] + rows[idx]) + "\n")
+            shutil.copyfile(path / "amrfinder.err", f"{sample}/amrfinder.err")
+        return [sample for sample, assembly in group]
+
+    def _run_batch(self, jobs, on_done = None, groups = None):
+        """
+        run the amrfinder jobs for a batch, a sample that fails is reported and left out of collation rather than stopping the batch. on_done is called with the name of each sample that completes.
+        groups are the samples of each multiplexed job, keyed on the job name - a group is split into its samples as soon as it completes, and if it fails its samples are run one at a time.
+        """
+        groups = groups if groups is not None else {}
+        missing = [] # samples amrfinder exited without error for but left no output
+
+        def done(r):
+            if r.returncode != 0:
+                if self.ledger is not None and r.name not in groups:
+                    self.ledger.finish(r.name, returncode = r.returncode, wall = r.wall)
+                if self.progress is not None and r.name not in groups:
+                    self.progress.fail(r.name)
+                return
+            samples = self._demultiplex(r.name, groups[r.name]) if r.name in groups else [r.name]
+            if self.ledger is not None:
+                lost = [sample for sample in samples if not self.ledger.finish(sample, returncode = 0, wall = r.wall)]
+                for sample in lost:
+                    if self.progress is not None:
+                        self.progress.fail(sample)
+                missing.extend(lost)
+                samples = [sample for sample in samples if sample not in lost]
+            if on_done is not None:
+                for sample in samples:
+                    on_done(sample)
+
+        results = Executor(jobs = self.jobs, retries = self.retries).run(jobs, on_done = done)
+        retry = [sample for name, r in results.items() if name in groups and r.returncode != 0 for sample in groups[name]]
+        if retry:
+            self.logger.warning(f"amrfinder failed for a group of multiplexed samples - {len(retry)} samples will be run one at a time.")
+            results.update(Executor(jobs = self.jobs, retries = self.retries).run(self._batch_cmd(samples = retry), on_done = done))
+        for name, r in list(results.items()):
+            if name in groups:
+                results.pop(name)
+                if r.returncode == 0:
+                    results.update({sample: r for sample, assembly in groups[name]})
+        
+        self.failed = [name for name, r in results.items() if r.returncode != 0]
+        for name in self.failed:
+            self.logger.critical(f"amrfinder failed for {name} with exit code {results[name].returncode} after {results[name].attempts} attempts, see {name}/amrfinder.err. {name} will not be collated.")
+        for name in missing:
+            self.logger.critical(f"amrfinder exited without error for {name} but {name}/amrfinder.out is missing, see {name}/amrfinder.err. {name} will not be collated.")
+        self.failed.extend(missing)
+        if results and len(self.failed) == len(results):
+            self.logger.critical(f"amrfinder failed for every sample. Please check all inputs and try again.")
+            raise SystemExit
+        self.logger.info(f"AMRfinder completed successfully for {len(results) - len(self.failed)} of {len(results)} samples. Will now move on to collation.")
+        return results
     
     def _single_cmd(self):
         """
@@ -77,9 +342,9 @@ class RunFinder(object):
 
     def _generate_cmd(self):
         """
-        Generate a command to run amrfinder
+        Generate a command to run amrfinder - a batch is run as a job per sample (see _batch_cmd)
         """
-        cmd = self._batch_cmd() if self.run_type == 'batch' else self._single_cmd()
+        cmd = self._single_cmd()
         return cmd
         
     def _run_cmd(self, cmd):
@@ -111,14 +376,105 @@ class RunFinder(object):
         if self.run_type != 'batch':
             self._check_output_file(f"{self.prefix}/amrfinder.out")
         else:
-            tab = pandas.read_csv(self.input, sep = '\t', header = None)
-            for row in tab.iterrows():
-                self._check_output_file(f"{row[1][0]}/amrfinder.out")
+            for sample, assembly in self._get_samples():
+                if sample not in self.failed:
+                    self._check_output_file(f"{sample}/amrfinder.out")
         return True
 
-    def run(self):
+    def _settings(self, samples):
+        """
+        the settings that change the amrfinder output of each sample, recorded in the ledger
+        """
+        return {sample: make_key(self._organism(sample), self.identity, self._db_version()) for sample, assembly in samples}
+
+    def _batch(self, on_done = None):
+        """
+        run amrfinder for the samples of a batch - each is recorded in the ledger as it finishes, and with resume those already complete are not run again. Return the cache keys of the samples that were run.
+        """
+        self.ledger = Ledger()
+        samples = self._get_samples()
+        settings = self._settings(samples)
+        self.progress = Progress(total = len(samples))
+        if self.resume:
+            complete = set(self.ledger.complete(samples = samples, settings = settings))
+            self.logger.info(f"Resuming a batch - {len(complete)} of {len(samples)} samples are already complete and will not be run again.")
+            for sample in complete:
+                self.progress.complete(sample, skipped = True)
+                if on_done is not None:
+                    on_done(sample)
+            samples = [(sample, assembly) for sample, assembly in samples if sample not in complete]
+        self.ledger.plan(samples = samples, settings = settings)
+        samples, duplicates = self._deduplicate(samples)
+
+        def done(sample, skipped = False):
+            self._fan_out(sample, duplicates.get(sample, []))
+            for dup in duplicates.get(sample, []):
+                self.ledger.finish(dup, returncode = 0)
+            for s in [sample] + duplicates.get(sample, []):
+                self.progress.complete(s, skipped = skipped)
+            if on_done is not None:
+                for s in [sample] + duplicates.get(sample, []):
+                    on_done(s)
+
+        def found(sample):
+            self.ledger.finish(sample, returncode = 0)
+            done(sample, skipped = True)
+
+        samples, keys = self._from_cache(samples, on_done = found)
+        self._clear_outputs(samples)
+        multiplexed, singles = self._plan_multiplex(samples)
+        jobs = self._batch_cmd(samples = singles)
+        groups = {}
+        if multiplexed:
+            tmp = pathlib.Path(tempfile.mkdtemp(prefix = "abritamr_multiplex_", dir = "."))
+            for n, group in enumerate(multiplexed):
+                job = self._multiplex_job(path = tmp / f"group{n}", group = group)
+                groups[job.name] = group
+                jobs.append(job)
+            self.logger.info(f"{len(samples) - len(singles)} small assemblies will be run in {len(multiplexed)} multiplexed amrfinder jobs.")
+        self.logger.info(f"You are running abritamr in {self.run_type} mode. Now running amrfinder for {len(samples)} samples in {len(jobs)} jobs with {self.jobs} threads - grouped by organism, largest assemblies first.")
+        try:
+            results = self._run_batch(jobs, on_done = done, groups = groups)
+            for sample in list(self.failed):
+                for dup in duplicates.get(sample, []):
+                    self.ledger.finish(dup, returncode = results[sample].returncode)
+                    self.progress.fail(dup)
+                    self.failed.append(dup)
+        finally:
+            self.progress.finish()
+            if multiplexed:
+                shutil.rmtree(tmp, ignore_errors = True)
+            self.ledger.close()
+        return keys
+
+    def _batch_with_db(self, on_done = None):
+        """
+        run the batch with the amrfinder DB read into the page cache first and/or staged in fast local storage if asked for
         """
-        run amrfinder
+        if (self.prewarm_db or self.stage_db) and not self.amrfinder_db:
+            self.logger.warning(f"No amrfinder DB path was given so the DB can not be prewarmed or staged.")
+            return self._batch(on_done = on_done)
+        if self.prewarm_db:
+            self.logger.info(f"Read {prewarm(self.amrfinder_db) / 1e6:.0f} MB of the amrfinder DB into the page cache.")
+        if not self.stage_db:
+            return self._batch(on_done = on_done)
+        with StagedDB(source = self.amrfinder_db, dest = self.stage_db) as staged:
+            self.amrfinder_db = staged
+            try:
+                return self._batch(on_done = on_done)
+            finally:
+                self.amrfinder_db = self.source_db
+
+    def amr_data(self):
+        """
+        the inputs for collation
+        """
+        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'stream', 'no_cache', 'cache_size', 'failed'])
+        return Data(self.run_type, self.input, self.prefix, self.jobs, self.stream, self.no_cache, self.cache_size, self.failed)
+
+    def run(self, on_done = None):
+        """
+        run amrfinder - in batch mode on_done is called with the name of each sample as its output is ready, so that it can be collated while the rest are run
         """
         if self._check_amrfinder():
             self.logger.info(f"All check complete now running AMRFinder")
@@ -127,11 +483,16 @@ class RunFinder(object):
         else:
             self.logger.critical(f"Your amrfinder database version is NOT {self.db}. abriTAMR will still run but behaviour may not be as expected in terms of binnig genes into the appropriate drug classes.")
             # raise SystemExit
-        cmd = self._generate_cmd()
-        self.logger.info(f"You are running abritamr in {self.run_type} mode. Now executing : {cmd}")
-        self._run_cmd(cmd)
+        if self.run_type == 'batch':
+            keys = self._batch_with_db(on_done = on_done)
+        else:
+            samples, keys = self._from_cache([(self.prefix, self.input)])
+            cmd = self._generate_cmd()
+            if samples:
+                self._clear_outputs(samples)
+                self.logger.info(f"You are running abritamr in {self.run_type} mode. Now executing : {cmd}")
+                self._run_cmd(cmd)
         self._check_outputs()
-        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix'])
-        amr_data = Data(self.run_type, self.input, self.prefix)
-
-        return amr_data
+        if keys:
+            self._to_cache(keys)
+        return self.amr_data()
@@ -0,0 +1,82 @@
+import pathlib, hashlib, shutil, tempfile
+from abritamr.CustomLog import get_logger
+from abritamr.Cache import sha256sum
+
+CHUNK = 1 << 20
+
+
+def prewarm(source):
+    """
+    read every file of the amrfinder DB once so that it is in the page cache before the jobs start, return the number of bytes read
+    """
+    total = 0
+    for f in sorted(pathlib.Path(source).rglob("*")):
+        if f.is_file():
+            with open(f, "rb") as fh:
+                for chunk in iter(lambda: fh.read(CHUNK), b""):
+                    total += len(chunk)
+    return total
+
+
+class StagedDB:
+    """
+    A checked copy of the amrfinder DB in fast local storage (eg /dev/shm or node local scratch) for the length of a run - used as a context manager, which returns the path of the DB to use and removes the copy at the end.
+    If the DB can not be copied (not enough space, a checksum that does not match) the source is used instead.
+    """
+
+    def __init__(self, source, dest):
+
+        self.logger = get_logger(__name__)
+        self.source = pathlib.Path(source)
+        self.dest = pathlib.Path(dest)
+        self.tmp = None
+
+    def _copy(self, src, dst):
+        """
+        copy a file, return the sha256 of what was read from src
+        """
+        h = hashlib.sha256()
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            for chunk in iter(lambda: s.read(CHUNK), b""):
+                h.update(chunk)
+                d.write(chunk)
+        return h.hexdigest()
+
+    def _stage(self):
+        """
+        copy the DB to dest and check each file against what was read from the source, return the path of the copy
+        """
+        files = [f for f in self.source.rglob("*") if f.is_file()]
+        size = sum(f.stat().st_size for f in files)
+        free = shutil.disk_usage(self.dest).free
+        if size > free:
+            raise OSError(f"{size} bytes are needed for the DB and {self.dest} has {free} bytes free")
+        self.tmp = pathlib.Path(tempfile.mkdtemp(prefix = "abritamr_db_", dir = self.dest))
+        staged = self.tmp / self.source.name # the DB keeps its name, which is its version
+        for f in files:
+            target = staged / f.relative_to(self.source)
+            target.parent.mkdir(parents = True, exist_ok = True)
+            if self._copy(f, target) != sha256sum(target):
+                raise OSError(f"the copy of {f} does not match the source")
+        self.logger.info(f"Staged the amrfinder DB ({size / 1e6:.0f} MB) in {staged}")
+        return staged
+
+    def __enter__(self):
+
+        try:
+            return f"{self._stage()}"
+        except OSError as e:
+            self.logger.warning(f"Could not stage the amrfinder DB in {self.dest} ({e}). {self.source} will be used.")
+            self._clean()
+            return f"{self.source}"
+
+    def _clean(self):
+
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors = True)
+            self.tmp = None
+
+    def __exit__(self, *args):
+
+        self._clean()
+        return False
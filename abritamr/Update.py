@@ -1,17 +1,8 @@
 import pandas, pathlib, numpy, subprocess,logging,json,datetime
-from abritamr.CustomLog import CustomFormatter
-
-logger =logging.getLogger(__name__) 
-logger.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(CustomFormatter())
-fh = logging.FileHandler('update_abritamr_db.log')
-fh.setLevel(logging.INFO)
-formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-fh.setFormatter(formatter)
-logger.addHandler(ch) 
-logger.addHandler(fh)
+from abritamr.CustomLog import setup_logging
+from abritamr.RefGenes import load_reftab
+
+logger = logging.getLogger(__name__)
 
 def _get_date():
 
@@ -276,12 +267,14 @@ def _compare_to_existing(new_catalog, previous_catalog):
 
 def create_refgenes():
 
+    setup_logging("update_abritamr_db.log")
     rename_key,other_amr,other_non_amr,oxa_phen_list,adrs = _get_vars()
     new_catalog_df = _open_catalog()
     new_catalog = _make_dict(df = new_catalog_df ,other_amr =other_amr,other_non_amr=other_non_amr,rename_key=rename_key)
     existing = _get_previous_refgenes()
     new_catalog = _compare_to_existing(new_catalog=new_catalog,previous_catalog=existing)
     pth = _save_df(df=new_catalog)
-    logger.info(f"Saved new refgenes catalog as {pth} and emailing for confirmation.")
+    snapshot = load_reftab(pth).attrs.get("snapshot", "the csv only - a snapshot could not be made")
+    logger.info(f"Saved new refgenes catalog as {pth} (compiled with its resolution table to {snapshot}, where abritamr will load it once installed) and emailing for confirmation.")
     _email(adrs = adrs, pth = pth)
     
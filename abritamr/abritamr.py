@@ -1,32 +1,70 @@
 import pathlib, argparse, sys, os, logging,json
 
-from abritamr.AmrSetup import SetupAMR, SetupMDU
-from abritamr.RunFinder import RunFinder
-from abritamr.Collate import Collate, MduCollate
-from abritamr.Update import create_refgenes
 from abritamr.version import __version__, db
+from abritamr.CustomLog import setup_logging, LOG
 
 """
 abritamr is designed to implement AMRFinder and parse the results compatible for MDU use. It may also be used for other purposes where the format of output is compatible
 
 """
 
+# the pipeline modules pull in pandas and numpy - they are only imported by the subcommand that needs them so that help, version and argument errors stay fast
+
+def _species(species):
+    """
+    check the species against species_config.json when it is given, rather than reading the config to build choices for every call
+    """
+    if species == "":
+        return species
+    species_list = json.load(open(f"{pathlib.Path(__file__).parent / 'species_config.json'}",'r'))
+    if species not in species_list:
+        raise argparse.ArgumentTypeError(f"invalid choice: '{species}' (choose from {', '.join(species_list)})")
+    return species
+
 def update_db(args):
 
+    from abritamr.Update import create_refgenes
     create_refgenes()
 
 def run_pipeline(args):
 
+    setup_logging(args.log)
+    from abritamr.AmrSetup import SetupAMR
+    from abritamr.RunFinder import RunFinder
+    from abritamr.Collate import Collate
     P = SetupAMR(args)
     input_data = P.setup()
+    if args.report:
+        # the report inputs are checked before amrfinder is run, the summaries it is made from are those this run saves
+        from abritamr.AmrSetup import SetupMDU
+        path = '' if input_data.run_type == 'batch' else f"{input_data.prefix}/"
+        args.matches = f"{path}summary_matches.txt"
+        args.partials = f"{path}summary_partials.txt"
+        M = SetupMDU(args)
+        M.check_report()
     A = RunFinder(input_data)
-    amr_data = A.run()
-    C = Collate(amr_data)
-    C.run()
+    if input_data.pipeline and input_data.run_type == 'batch' and not input_data.stream:
+        # collate each sample as soon as its amrfinder output is ready
+        C = Collate(A.amr_data())
+        C.start_pipeline()
+        amr_data = A.run(on_done = C.add)
+        C.failed = amr_data.failed
+    else:
+        amr_data = A.run()
+        C = Collate(amr_data)
+    summaries = C.run()
+    if args.report:
+        from abritamr.Collate import MduCollate
+        # the summaries are handed over as they are, rather than read back from the files just saved - unless they were streamed to file
+        matches, partials = summaries if summaries is not None else (None, None)
+        MduCollate(M.setup()).run(matches = matches, partials = partials)
     
 
 def mdu(args):
     
+    setup_logging(args.log)
+    from abritamr.AmrSetup import SetupMDU
+    from abritamr.Collate import MduCollate
     M = SetupMDU(args)
     input_data = M.setup()
     C = MduCollate(input_data)
@@ -46,7 +84,7 @@ def main():
         "--contigs",
         "-c",
         default="",
-        help="Tab-delimited file with sample ID as column 1 and path to assemblies as column 2 OR path to a contig file (used if only doing a single sample - should provide value for -pfx). ",
+        help="Tab-delimited file with sample ID as column 1, path to assemblies as column 2 and optionally the organism of each sample (one of species_config.json, used instead of --species) as column 3 OR path to a contig file (used if only doing a single sample - should provide value for -pfx). ",
     )
     parser_sub_run.add_argument(
         "--prefix",
@@ -58,7 +96,7 @@ def main():
         "--jobs", 
         "-j", 
         default=16, 
-        help="Number of AMR finder jobs to run in parallel."
+        help="Number of AMR finder jobs to run in parallel - the largest assemblies are started first and each is given threads (up to 8) in proportion to its share of the work left."
     )
     parser_sub_run.add_argument(
         "--identity", 
@@ -78,24 +116,85 @@ def main():
         "--species",
         "-sp",
         default="",
-        help="Set if you would like to use point mutations, please provide a valid species.",
-        choices= json.load(open(f"{pathlib.Path(__file__).parent / 'species_config.json'}",'r'))
+        help="Set if you would like to use point mutations, please provide a valid species (see species_config.json).",
+        type=_species
+    )
+    parser_sub_run.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write collated results as each chunk of isolates is collated (batch mode only). Keeps memory use flat for very large batches."
+    )
+    parser_sub_run.add_argument(
+        "--no-cache",
+        "--no_cache",
+        dest="no_cache",
+        action="store_true",
+        help="Do not use or update the abritamr cache (set ABRITAMR_CACHE to change where it is kept)."
+    )
+    parser_sub_run.add_argument(
+        "--cache_size",
+        default=1024,
+        help="Maximum size of each abritamr cache (amrfinder results and collation) in MB, least recently used entries are removed first."
     )
     
-    parser_mdu = subparsers.add_parser('report', help='Generate report for use at MDU', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    
-    parser_mdu.add_argument(
-        "--qc",
-        "-q",
+    parser_sub_run.add_argument(
+        "--retries",
+        default=1,
+        help="Number of times to retry amrfinder for a sample that fails (batch mode only)."
+    )
+    parser_sub_run.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Collate each sample as soon as amrfinder has finished with it, rather than once the whole batch is done (batch mode only, not used with --stream)."
+    )
+    parser_sub_run.add_argument(
+        "--multiplex",
+        default=0,
+        help="Run amrfinder once for each group of small assemblies, with up to this many bases in a group (batch mode only). Assemblies this size or larger are run on their own. 0 runs every assembly on its own."
+    )
+    parser_sub_run.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only run the samples of a batch that did not complete in an earlier run in this directory (see abritamr_ledger.sqlite3)."
+    )
+    parser_sub_run.add_argument(
+        "--stage_db",
         default="",
-        help="Name of checked MDU QC file."
+        help="Copy the amrfinder DB into this directory (eg /dev/shm or node local scratch) for a batch, check the copy and remove it at the end. Useful when the DB is on a network file system."
     )
-    parser_mdu.add_argument(
-        "--runid",
-        "-r",
-        default=f"Run ID",
-        help="MDU RunID",
+    parser_sub_run.add_argument(
+        "--prewarm_db",
+        action="store_true",
+        help="Read the amrfinder DB into the page cache before a batch starts."
+    )
+    parser_sub_run.add_argument(
+        "--log",
+        default=LOG,
+        help="Path of the log file for this run - give each run its own log when running several in one directory."
+    )
+    
+    parser_mdu = subparsers.add_parser('report', help='Generate report for use at MDU', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # the report can also be made at the end of a run, from the collated results as they are in memory
+    parser_sub_run_report = parser_sub_run.add_argument_group('report', 'Make the MDU report at the end of the run')
+    parser_sub_run_report.add_argument(
+        "--report",
+        action="store_true",
+        help="Make the MDU report from the results of this run, as abritamr report would."
     )
+    
+    for p in [parser_mdu, parser_sub_run_report]:
+        p.add_argument(
+            "--qc",
+            "-q",
+            default="",
+            help="Name of checked MDU QC file."
+        )
+        p.add_argument(
+            "--runid",
+            "-r",
+            default=f"Run ID",
+            help="MDU RunID",
+        )
     parser_mdu.add_argument(
         "--matches",
         "-m",
@@ -108,16 +207,35 @@ def main():
         default=f"summary_partials.txt",
         help="Path to partial matches, concatentated output of abritamr",
     )
+    for p in [parser_mdu, parser_sub_run_report]:
+        p.add_argument(
+            "--sop",
+            default=f"general",
+            choices = ['general', 'plus'],
+            help="The pipeline for reporting results."
+        )
+        p.add_argument(
+            "--sop_name",
+            default=f"",
+            help="The name of the process - will be reflected in the names od the output files."
+        )
+        p.add_argument(
+            "--formats",
+            nargs="+",
+            default=["xlsx"],
+            choices=["xlsx", "csv", "parquet"],
+            help="Formats to save the report in - xlsx is one workbook, csv and parquet a file for each sheet (parquet needs pyarrow)."
+        )
+        p.add_argument(
+            "--rules",
+            default="",
+            help="Path to a json file of reporting rules for the general sop, if not using those that come with abritamr."
+        )
+
     parser_mdu.add_argument(
-        "--sop",
-        default=f"general",
-        choices = ['general', 'plus'],
-        help="The pipeline for reporting results."
-    )
-    parser_mdu.add_argument(
-        "--sop_name",
-        default=f"",
-        help="The name of the process - will be reflected in the names od the output files."
+        "--log",
+        default=LOG,
+        help="Path of the log file for this run."
     )
 
     parser_update = subparsers.add_parser('update_db', help='Download and curate the Reference gene catalog from NCBI', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -53,5 +53,5 @@ setup(
         "Programming Language :: Python :: 3.9",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
     ],
-    package_data={"abritamr": ["db/amrfinderplus/data/2024-07-22.1/*", "species_config.json","db/refgenes_latest.csv"]}
+    package_data={"abritamr": ["db/amrfinderplus/data/2024-07-22.1/*", "species_config.json","reporting_rules.json","db/refgenes_latest.csv"]}
 )
@@ -1,10 +1,15 @@
-import sys, pathlib, pandas, pytest, numpy, logging, collections
+import sys, os, pathlib, pandas, pytest, numpy, logging, collections, json, multiprocessing
 
 from unittest.mock import patch, PropertyMock
 
 from abritamr.AmrSetup import Setup, SetupAMR, SetupMDU
 from abritamr.RunFinder import RunFinder
 from abritamr.Collate import Collate, MduCollate
+from abritamr.RefGenes import RefGeneIndex, load_reftab, load_resolution, lookup_resolution
+from abritamr.Cache import FileCache
+from abritamr.StageDB import StagedDB, prewarm
+from abritamr.Progress import Progress
+from abritamr.ReportingRules import ReportingRules
 
 
 
@@ -12,6 +17,13 @@ test_folder = pathlib.Path(__file__).parent
 REFGENES = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'refgenes_latest.csv'}"
 CONTROLS = pathlib.Path(__file__).parent.parent /'abritamr' / 'control'
 
+@pytest.fixture(autouse = True)
+def abritamr_cache(tmp_path_factory, monkeypatch):
+    """
+    keep the refgenes snapshots and caches made by a test out of the user's cache
+    """
+    monkeypatch.setenv("ABRITAMR_CACHE", f"{tmp_path_factory.mktemp('abritamr_cache')}")
+
 def test_file_present():
     """
     assert true when the input file is true
@@ -89,9 +101,18 @@ def test_setup_contigs():
         amr_obj.species = ''
         amr_obj.identity = ''
         amr_obj.amrfinder_db = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus'/ 'data'/ '2022-08-09.1'}"
+        amr_obj.stream = False
+        amr_obj.no_cache = False
+        amr_obj.cache_size = 1024
+        amr_obj.retries = 1
+        amr_obj.pipeline = False
+        amr_obj.multiplex = 0
+        amr_obj.resume = False
+        amr_obj.stage_db = ''
+        amr_obj.prewarm_db = False
         amr_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db'])
-        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db', 'stream', 'no_cache', 'cache_size', 'retries', 'pipeline', 'multiplex', 'resume', 'stage_db', 'prewarm_db'])
+        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db, amr_obj.stream, amr_obj.no_cache, amr_obj.cache_size, amr_obj.retries, amr_obj.pipeline, amr_obj.multiplex, amr_obj.resume, amr_obj.stage_db, amr_obj.prewarm_db)
         assert amr_obj.setup() == input_data
 
 def test_species():
@@ -103,9 +124,18 @@ def test_species():
         amr_obj.species = 'Neiserria'
         amr_obj.identity = ''
         amr_obj.amrfinder_db = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus'/ 'data'/ '2022-08-09.1'}"
+        amr_obj.stream = False
+        amr_obj.no_cache = False
+        amr_obj.cache_size = 1024
+        amr_obj.retries = 1
+        amr_obj.pipeline = False
+        amr_obj.multiplex = 0
+        amr_obj.resume = False
+        amr_obj.stage_db = ''
+        amr_obj.prewarm_db = False
         amr_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db'])
-        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db', 'stream', 'no_cache', 'cache_size', 'retries', 'pipeline', 'multiplex', 'resume', 'stage_db', 'prewarm_db'])
+        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db, amr_obj.stream, amr_obj.no_cache, amr_obj.cache_size, amr_obj.retries, amr_obj.pipeline, amr_obj.multiplex, amr_obj.resume, amr_obj.stage_db, amr_obj.prewarm_db)
         assert amr_obj.setup() == input_data
 
 
@@ -118,9 +148,18 @@ def test_setup_batch():
         amr_obj.species = ''
         amr_obj.identity = ''
         amr_obj.amrfinder_db = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus'/ 'data'/ '2022-08-09.1'}"
+        amr_obj.stream = False
+        amr_obj.no_cache = False
+        amr_obj.cache_size = 1024
+        amr_obj.retries = 1
+        amr_obj.pipeline = False
+        amr_obj.multiplex = 0
+        amr_obj.resume = False
+        amr_obj.stage_db = ''
+        amr_obj.prewarm_db = False
         amr_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism','identity', 'amrfinder_db'])
-        input_data = T('batch', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity,amr_obj.amrfinder_db)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism','identity', 'amrfinder_db', 'stream', 'no_cache', 'cache_size', 'retries', 'pipeline', 'multiplex', 'resume', 'stage_db', 'prewarm_db'])
+        input_data = T('batch', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity,amr_obj.amrfinder_db, amr_obj.stream, amr_obj.no_cache, amr_obj.cache_size, amr_obj.retries, amr_obj.pipeline, amr_obj.multiplex, amr_obj.resume, amr_obj.stage_db, amr_obj.prewarm_db)
         assert amr_obj.setup() == input_data
  
 def test_setup_fail():
@@ -138,7 +177,7 @@ def test_setup_fail():
             amr_obj.setup()
 
 # # Test SetupMDU
-MDU = collections.namedtuple('MDU', ['runid', 'matches', 'partials', 'qc', 'sop', 'sop_name'])
+MDU = collections.namedtuple('MDU', ['runid', 'matches', 'partials', 'qc', 'sop', 'sop_name', 'rules', 'formats'], defaults = ['', ['xlsx']])
 
 def test_prefix_string():
     """
@@ -170,8 +209,8 @@ def test_mdu_setup_success():
     with patch.object(SetupAMR, "__init__", lambda x: None):
         args = MDU("RUNID", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name')
         amr_obj = SetupMDU(args)
-        Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid','sop', 'sop_name'])
-        d = Data(args.qc, args.matches, args.partials, amr_obj.db, args.runid, args.sop, args.sop_name)
+        Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid','sop', 'sop_name', 'rules', 'formats'])
+        d = Data(args.qc, args.matches, args.partials, amr_obj.db, args.runid, args.sop, args.sop_name, args.rules, args.formats)
         amr_obj.logger = logging.getLogger(__name__)
         assert amr_obj.setup() == d
 
@@ -207,9 +246,11 @@ def test_batch_cmd_no_org():
         amr_obj.input = args.input
         amr_obj.amrfinder_db = "2021-06-01.1"
         amr_obj.identity = ''
-        cmd = f"parallel -j {args.jobs} --colsep '\\t' 'mkdir -p {{1}} && amrfinder -n {{2}} -o {{1}}/amrfinder.out --plus  --threads 1 -d {amr_obj.amrfinder_db}' :::: {args.input}"
         amr_obj.logger = logging.getLogger(__name__)
-        assert amr_obj._batch_cmd() == cmd
+        jobs = amr_obj._batch_cmd()
+        assert [j.name for j in jobs] == ['tests', 'tests']
+        assert [j.err for j in jobs] == ['tests/amrfinder.err', 'tests/amrfinder.err']
+        assert jobs[0].cmd == ['amrfinder', '-n', 'tests/summary_matches.txt', '-o', 'tests/amrfinder.out', '--plus', '--threads', '{threads}', '-d', amr_obj.amrfinder_db]
 
 def test_batch_cmd_with_org():
     """
@@ -225,9 +266,10 @@ def test_batch_cmd_with_org():
         amr_obj.input = args.input
         amr_obj.amrfinder_db = "2021-06-01.1"
         amr_obj.identity = ''
-        cmd = f"parallel -j {args.jobs} --colsep '\\t' 'mkdir -p {{1}} && amrfinder -n {{2}} -o {{1}}/amrfinder.out --plus --organism {args.organism} --threads 1 -d {amr_obj.amrfinder_db}' :::: {args.input}"
         amr_obj.logger = logging.getLogger(__name__)
-        assert amr_obj._batch_cmd() == cmd
+        jobs = amr_obj._batch_cmd()
+        assert [j.name for j in jobs] == ['tests', 'tests']
+        assert jobs[0].cmd == ['amrfinder', '-n', 'tests/summary_matches.txt', '-o', 'tests/amrfinder.out', '--plus', '--threads', '{threads}', '--organism', args.organism, '-d', amr_obj.amrfinder_db]
 
 def test_batch_cmd_with_neiserria():
     """
@@ -243,9 +285,10 @@ def test_batch_cmd_with_neiserria():
         amr_obj.input = args.input
         amr_obj.amrfinder_db = "2021-06-01.1"
         amr_obj.identity = ''
-        cmd = f"parallel -j {args.jobs} --colsep '\\t' 'mkdir -p {{1}} && amrfinder -n {{2}} -o {{1}}/amrfinder.out --plus --organism {args.organism} --threads 1 -d {amr_obj.amrfinder_db}' :::: {args.input}"
         amr_obj.logger = logging.getLogger(__name__)
-        assert amr_obj._batch_cmd() == cmd
+        jobs = amr_obj._batch_cmd()
+        assert [j.name for j in jobs] == ['tests', 'tests']
+        assert jobs[0].cmd == ['amrfinder', '-n', 'tests/summary_matches.txt', '-o', 'tests/amrfinder.out', '--plus', '--threads', '{threads}', '--organism', args.organism, '-d', amr_obj.amrfinder_db]
 
 def test_single_cmd_with_org():
     """
@@ -453,6 +496,56 @@ def test_setup_dict():
         assert amr_obj.setup_dict(drugclass_dict, reftab, row) == {"Beta-lactam":['blaSHV-11']}
 
 
+def test_refindex_drugclass_unknown():
+    """
+    assert Unknown when the gene is not in any of the indexed columns
+    """
+    reftab = pandas.read_csv(REFGENES)
+    reftab = reftab.fillna('-')
+    refindex = RefGeneIndex(reftab)
+    assert refindex.drugclass(colname = 'allele', gene_id = 'notagene') == 'Unknown'
+
+def test_refindex_gene_name_fallback():
+    """
+    assert the gene family is returned when the accession is only found in the genbank columns
+    """
+    reftab = pandas.read_csv(REFGENES)
+    reftab = reftab.fillna('-')
+    refindex = RefGeneIndex(reftab)
+    assert refindex.gene_name(protein = 'BAM16262.1') == "aac(2')-IIa"
+
+
+def test_load_reftab_snapshot(tmp_path):
+    """
+    assert the compiled snapshot is built and then rebuilt when the csv changes
+    """
+    refgenes = tmp_path / 'refgenes_latest.csv'
+    reftab = pandas.read_csv(REFGENES)
+    reftab.head(5).to_csv(refgenes, index = False)
+    with patch.dict('os.environ', {'ABRITAMR_CACHE': f"{tmp_path / 'cache'}"}):
+        assert list(load_reftab(refgenes)['allele']) == list(reftab.head(5)['allele'].fillna('-'))
+        assert len(list((tmp_path / 'cache' / 'refgenes').iterdir())) == 1
+        reftab.head(7).to_csv(refgenes, index = False)
+        assert len(load_reftab(refgenes)) == 7
+        assert len(list((tmp_path / 'cache' / 'refgenes').iterdir())) == 2
+
+
+def test_resolution(tmp_path):
+    """
+    assert the resolution table compiled with the snapshot agrees with resolving each hit, and a key that is not in it is left to the slow path
+    """
+    refgenes = tmp_path / 'refgenes_latest.csv'
+    pandas.read_csv(REFGENES).head(50).to_csv(refgenes, index = False)
+    with patch.dict('os.environ', {'ABRITAMR_CACHE': f"{tmp_path / 'cache'}"}):
+        refindex = RefGeneIndex(load_reftab(refgenes))
+    resolution = load_resolution(snapshot = refindex.snapshot)
+    keys = [tuple(k.split('\t')) for k in resolution[0].tolist()]
+    assert len(keys) > 0
+    assert lookup_resolution(resolution = resolution, keys = keys) == [refindex.resolve(symbol = s, accession = a, method = m) for s, a, m in keys]
+    assert lookup_resolution(resolution = resolution, keys = [('notagene', 'WP_000000000.1', 'EXACTX'), (numpy.nan, 'WP_000000000.1', 'EXACTX')]) == [None, None]
+    assert load_resolution(snapshot = None) is None
+
+
 def test_get_per_isolate():
     """
     assert True when non-empty string is given
@@ -491,6 +584,101 @@ def test_collate():
         assert amr_obj.collate(isolate)[2].equals(virulence)
 
 
+def test_batch_collate():
+    """
+    assert batch collation gives the same table as collating each isolate on its own
+    """
+    with patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = Collate()
+        amr_obj.logger = logging.getLogger(__name__)
+        single = amr_obj.collate('tests')
+        batch = amr_obj._batch_collate(input_file = f"{test_folder / 'batch.txt'}")
+        for s, b in zip(single, batch):
+            expected = pandas.concat([s, s])
+            assert list(b.columns) == list(expected.columns)
+            assert b.set_index('Isolate').to_csv(sep = '\t') == expected.set_index('Isolate').to_csv(sep = '\t')
+
+
+def test_batch_collate_parallel(tmp_path):
+    """
+    assert collating with a pool of workers gives the same tables as collating in serial, and the log listener is not running while the workers are forked
+    """
+    import threading
+    from abritamr.CustomLog import setup_logging, stop_logging
+    setup_logging(tmp_path / 'abritamr.log')
+    threads = []
+    fork = multiprocessing.get_context("fork")
+    start = fork.Pool
+    def pool(*args, **kwargs):
+        threads.append(threading.active_count())
+        return start(*args, **kwargs)
+    with patch.object(Collate, "__init__", lambda x: None), patch.object(Collate, "MIN_CHUNK", 1):
+        amr_obj = Collate()
+        amr_obj.logger = logging.getLogger(__name__)
+        serial = amr_obj._batch_collate(input_file = f"{test_folder / 'batch.txt'}")
+        with patch.object(fork, "Pool", pool):
+            parallel = amr_obj._batch_collate(input_file = f"{test_folder / 'batch.txt'}", jobs = 2)
+        for s, p in zip(serial, parallel):
+            assert s.equals(p)
+    assert threads == [1]
+    logging.getLogger("abritamr.Collate").info("logged after the pool")
+    stop_logging()
+    assert "logged after the pool" in (tmp_path / 'abritamr.log').read_text()
+
+
+def test_batch_collate_cached(tmp_path):
+    """
+    assert isolates are collated from the cache the second time and give the same tables
+    """
+    with patch.object(Collate, "__init__", lambda x: None), patch.dict('os.environ', {'ABRITAMR_CACHE': f"{tmp_path}"}):
+        amr_obj = Collate()
+        amr_obj.logger = logging.getLogger(__name__)
+        amr_obj.cache = FileCache('collate', 1024 * 1024)
+        first = amr_obj._batch_collate(input_file = f"{test_folder / 'batch.txt'}")
+        assert amr_obj.cache.misses == 1
+        second = amr_obj._batch_collate(input_file = f"{test_folder / 'batch.txt'}")
+        assert amr_obj.cache.hits == 1
+        for f, s in zip(first, second):
+            assert f.to_csv() == s.to_csv()
+
+def test_cache_evict(tmp_path):
+    """
+    assert the least recently used entries are removed when the cache is over its size
+    """
+    with patch.dict('os.environ', {'ABRITAMR_CACHE': f"{tmp_path}"}):
+        cache = FileCache('test', 10)
+        cache.put('aa1', b'123456')
+        cache.put('bb2', b'123456')
+        os.utime(cache.get('aa1'), (0, 0))
+        assert cache.evict() == 1
+        assert cache.get('aa1') is None
+        assert cache.get('bb2') is not None
+
+
+def test_stream_collate(tmp_path):
+    """
+    assert streaming collation writes the same files as collating in memory, and classifies each chunk once
+    """
+    with patch.object(Collate, "__init__", lambda x: None), patch.object(Collate, "STREAM_CHUNK", 1):
+        amr_obj = Collate()
+        amr_obj.logger = logging.getLogger(__name__)
+        (tmp_path / 'stream').mkdir()
+        (tmp_path / 'memory').mkdir()
+        batch = tmp_path / 'batch.txt'
+        with open(batch, 'w') as b:
+            for isolate in ['isolate2', 'isolate1']:
+                (tmp_path / isolate).mkdir()
+                (tmp_path / isolate / 'amrfinder.out').write_text((test_folder / 'amrfinder.out').read_text())
+                b.write(f"{tmp_path / isolate}\t{CONTROLS / 'contigs.fa'}\n")
+        with patch.object(Collate, "classify", autospec = True, side_effect = Collate.classify) as classify:
+            amr_obj._stream_collate(input_file = f"{batch}", path = f"{tmp_path / 'stream'}")
+        assert classify.call_count == 2
+        match, partial, virulence = amr_obj._batch_collate(input_file = f"{batch}")
+        amr_obj.save_files(f"{tmp_path / 'memory'}", match, partial, virulence)
+        for f in ['summary_matches.txt', 'summary_partials.txt', 'summary_virulence.txt', 'abritamr.txt']:
+            assert (tmp_path / 'stream' / f).read_text() == (tmp_path / 'memory' / f).read_text()
+
+
 def test_save():
     """
     assert True when non-empty string is given
@@ -631,7 +819,7 @@ def test_save_merge_both_empty():
 
 
 
-MduColls = collections.namedtuple('Data', ['sop', 'sop_name', 'qc','db','partials','matches','runid'])
+MduColls = collections.namedtuple('Data', ['sop', 'sop_name', 'qc','db','partials','matches','runid', 'rules', 'formats'], defaults = ['', ['xlsx']])
 def test_reporting_efaec_optra():
 
     with patch.object(Collate, "__init__", lambda x: None):
@@ -705,3 +893,439 @@ def test_reporting_df_shig():
         
         assert amr_obj.mdu_reporting_general(match=f"{test_folder / 'summary_matches_shig.txt'}").equals(df)
 
+
+
+def test_reporting_qc_lookup(tmp_path):
+    """
+    assert isolates are found in the QC file by exact match first, then by the first ISOLATE that contains them, and an isolate not in it stops the report
+    """
+    qc = tmp_path / 'qc.csv'
+    qc.write_text("ISOLATE,SPECIES_EXP,SPECIES_OBS,TEST_QC\n2024-123456-A,Salmonella enterica,Salmonella enterica,PASS\nrun/2024-12345,Shigella sonnei,Escherichia coli,PASS\n2024-12345,Salmonella enterica,Salmonella enterica,PASS\nrun/tests3,Staphylococcus aureus,Staphylococcus aureus,FAIL\n")
+    with patch.object(Collate, "__init__", lambda x: None):
+        args = MduColls('general', 'sop_name', f"{qc}", 'db', '', '', 'runid')
+        amr_obj = MduCollate(args)
+        amr_obj.logger = logging.getLogger(__name__)
+        found = amr_obj._qc_lookup(['2024-12345', 'tests3'])
+        assert list(found.index) == ['2024-12345', 'run/tests3']
+        assert list(found['SPECIES_OBS']) == ['Salmonella enterica', 'Staphylococcus aureus']
+        with pytest.raises(SystemExit):
+            amr_obj._qc_lookup(['tests4'])
+
+
+
+def test_reporting_rules(tmp_path):
+    """
+    assert the packaged rules decide on genes as the general sop does, and a rules file of another format is not used
+    """
+    rules = ReportingRules()
+    assert rules.reportable(col = 'Carbapenemase (MBL)', gene = 'blaL1', species = 'Stenotrophomonas maltophilia') is False
+    assert rules.reportable(col = 'Carbapenemase (MBL)', gene = 'blaL1', species = 'Escherichia coli') is True
+    assert rules.reportable(col = 'ESBL', gene = 'blaEC-5', species = 'Shigella sonnei') is False
+    assert rules.reportable(col = 'ESBL', gene = 'blaCTX-M-15', species = 'Shigella sonnei') is True
+    assert rules.reportable(col = 'ESBL', gene = 'blaCTX-M-15', species = 'Escherichia coli') is False
+    assert rules.reportable(col = 'Vancomycin', gene = 'vanA', species = 'Enterococcus faecium') is True
+    assert rules.reportable(col = 'Vancomycin', gene = 'vanR', species = 'Enterococcus faecium') is False
+    assert rules.reportable(col = 'Methicillin', gene = 'mecI', species = 'Staphylococcus aureus') is False
+    assert rules.reportable(col = 'Carbapenemase (OXA-51 family)', gene = 'blaOXA-51', species = 'Escherichia coli') is False
+    assert rules.reportable(col = 'Tetracycline', gene = 'tet(A)', species = 'Escherichia coli') is False
+    assert rules.negative_code(species = 'Staphylococcus aureus') == 'Mec_VanAB_Linez_NEG'
+    assert rules.negative_code(species = '') == 'CPase_16S_mcr_NEG'
+    # the negative codes of a rules file are the ones reported
+    from abritamr.ReportingRules import RULES
+    custom = json.loads(pathlib.Path(RULES).read_text())
+    custom["sops"]["general"]["negative_codes"]["Other"] = "Custom_NEG"
+    (tmp_path / 'custom.json').write_text(json.dumps(custom))
+    with patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = MduCollate(MduColls('general', 'sop_name', '', 'db', '', '', 'runid', f"{tmp_path / 'custom.json'}"))
+        amr_obj.logger = logging.getLogger(__name__)
+        row = (0, {"Isolate": 'tests', 'Tetracycline': 'tet(A)'})
+        assert amr_obj.reporting_logic_general(row = row, species = 'Escherichia coli') == (['Custom_NEG'], ['tet(A)'])
+        assert amr_obj.reporting_logic_general(row = row, species = 'Salmonella enterica') == (['CPase_ESBL_AmpC_16S_NEG'], ['tet(A)'])
+    bad = tmp_path / 'rules.json'
+    bad.write_text(json.dumps({"format": 2, "version": "x", "sops": {}}))
+    with pytest.raises(SystemExit):
+        ReportingRules(path = bad)
+
+
+
+def test_reporting_salmonella(tmp_path):
+    """
+    assert the Salmonella AST interpretation for a run is the same as for each isolate on its own
+    """
+    match = tmp_path / 'summary_matches.txt'
+    match.write_text(
+        "Isolate\tAminoglycosides (Ribosomal methyltransferase)\tTrimethoprim\tSulfonamide\tBeta-lactam\tOther class\n"
+        "2024-12345-1\trmtB\tdfrA12\tsul1,dfrA12\tblaTEM-1\trmtB,qacE\n"
+        "2024-12346\t\t\tsul2\t\t\n"
+    )
+    with patch.object(Collate, "__init__", lambda x: None):
+        args = MduColls('plus', 'sop_name', '', 'db', '', f"{match}", 'runid')
+        amr_obj = MduCollate(args)
+        amr_obj.logger = logging.getLogger(__name__)
+        report = amr_obj.mdu_reporting_salmonella(match = f"{match}", isolates = ['2024-12345-1', '2024-12346'])
+        df = pandas.read_csv(match, sep = '\t').fillna('')
+        for n, row in enumerate(df.iterrows()):
+            expected = amr_obj.reporting_logic_salmonella(row = row)
+            assert {c: expected[c] for c in report.columns} == report.iloc[n].to_dict()
+    assert report.iloc[0]['Trim-Sulpha - ResMech'] == 'dfrA12;sul1'
+    assert report.iloc[0]['Other - ResMech'] == 'qacE'
+    assert report.iloc[1]['Sulfathiazole - Interpretation'] == 'Resistant'
+    assert report.iloc[1]['Trim-Sulpha - Interpretation'] == 'Susceptible'
+    # a run where no drug class was found for any isolate
+    match.write_text("Isolate\n2024-12345\n")
+    with patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = MduCollate(args)
+        amr_obj.logger = logging.getLogger(__name__)
+        report = amr_obj.mdu_reporting_salmonella(match = f"{match}", isolates = ['2024-12345'])
+        expected = amr_obj.reporting_logic_salmonella(row = next(pandas.read_csv(match, sep = '\t').fillna('').iterrows()))
+    assert {c: expected[c] for c in report.columns} == report.iloc[0].to_dict()
+    assert (report.iloc[0]['Ampicillin - ResMech'], report.iloc[0]['Ampicillin - Interpretation']) == ('None detected', 'Susceptible')
+
+
+def test_save_sheets(tmp_path, monkeypatch):
+    """
+    assert the report is saved in each format asked for, and parquet is refused up front if pyarrow is not installed
+    """
+    import zipfile, importlib.util
+    monkeypatch.chdir(tmp_path)
+    with patch.object(Collate, "__init__", lambda x: None):
+        args = MduColls('general', 'sop_name', '', 'db', '', '', 'runid', formats = ['xlsx', 'csv'])
+        amr_obj = MduCollate(args)
+        amr_obj.logger = logging.getLogger(__name__)
+        df = pandas.DataFrame({"MDU sample ID": ['2024-12345', '2024-12346'], 'Item code': ['1', ''], 'Species_obs': ['Salmonella enterica', numpy.nan]}).set_index("MDU sample ID")
+        amr_obj.save_spreadsheet_general(df, df.iloc[:0])
+    assert (tmp_path / 'runid_sop_name_sop_name.csv').read_text() == "MDU sample ID,Item code,Species_obs\n2024-12345,1,Salmonella enterica\n2024-12346,,\n"
+    assert (tmp_path / 'runid_sop_name_Passed_QC_partial.csv').read_text() == "MDU sample ID,Item code,Species_obs\n"
+    with zipfile.ZipFile(tmp_path / 'runid_sop_name.xlsx') as z:
+        assert 'name="Passed QC partial"' in z.read('xl/workbook.xml').decode()
+    with patch.object(SetupAMR, "__init__", lambda x: None), patch.object(importlib.util, 'find_spec', lambda name: None):
+        amr_obj = SetupMDU(MDU("RUNID", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name', formats = ['parquet']))
+        amr_obj.logger = logging.getLogger(__name__)
+        with pytest.raises(SystemExit):
+            amr_obj.setup()
+
+
+
+def test_cli_lazy_imports():
+    """
+    assert the cli can be loaded and checks its arguments without importing pandas or numpy
+    """
+    import subprocess
+    code = "import sys, abritamr.abritamr; print('pandas' in sys.modules or 'numpy' in sys.modules)"
+    p = subprocess.run([sys.executable, '-c', code], capture_output = True, encoding = 'utf-8')
+    assert p.stdout.strip() == 'False'
+    p = subprocess.run([sys.executable, '-m', 'abritamr.abritamr', 'run', '--species', 'Not_a_species'], capture_output = True, encoding = 'utf-8')
+    assert p.returncode == 2
+    assert 'invalid choice' in p.stderr
+
+
+def test_setup_logging(tmp_path):
+    """
+    assert handlers are attached once and per isolate messages are rate limited
+    """
+    from abritamr.CustomLog import setup_logging, stop_logging, get_logger, IsolateFilter
+    log = tmp_path / 'run.log'
+    setup_logging(log)
+    setup_logging(log)
+    logger = get_logger('abritamr.test')
+    assert len(logging.getLogger('abritamr').handlers) == 1
+    logger.info('once')
+    for i in range(IsolateFilter.BURST + IsolateFilter.EVERY):
+        logger.info(f'isolate{i}', extra = {'isolate': f'isolate{i}'})
+    stop_logging()
+    lines = log.read_text().splitlines()
+    assert len([l for l in lines if l.endswith('once')]) == 1
+    assert len(lines) == 1 + IsolateFilter.BURST + 1
+    assert lines[-1].endswith('similar messages not shown)')
+
+
+def test_executor(tmp_path):
+    """
+    assert each job is run on its own with its exit code and stderr kept, and a failed job is retried
+    """
+    from abritamr.Executor import Executor, Job
+    jobs = [
+        Job('ok', [sys.executable, '-c', 'pass'], f"{tmp_path / 'ok' / 'amrfinder.err'}"),
+        Job('bad', [sys.executable, '-c', 'import sys; sys.stderr.write("boom"); sys.exit(3)'], f"{tmp_path / 'bad' / 'amrfinder.err'}"),
+        Job('missing', [f"{tmp_path / 'not_a_program'}"], f"{tmp_path / 'missing' / 'amrfinder.err'}")
+    ]
+    results = Executor(jobs = 2, retries = 1).run(jobs)
+    assert (results['ok'].returncode, results['ok'].attempts) == (0, 1)
+    assert (results['bad'].returncode, results['bad'].attempts) == (3, 2)
+    assert (tmp_path / 'bad' / 'amrfinder.err').read_text() == 'boom'
+    assert results['missing'].returncode != 0
+
+
+def _fake_amrfinder(tmp_path):
+    """
+    an amrfinder on PATH that writes the test output for every assembly and counts how often it is run
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake = bin_dir / 'amrfinder'
+    fake.write_text(f"""#!/bin/sh
+if [ "$1" = "--version" ]; then echo 3.12.8; exit 0; fi
+while [ $# -gt 0 ]; do if [ "$1" = "-o" ]; then out=$2; fi; shift; done
+echo run >> {tmp_path / 'runs.txt'}
+cp {test_folder / 'amrfinder.out'} $out
+""")
+    fake.chmod(0o755)
+    return {'PATH': f"{bin_dir}{os.pathsep}{os.environ['PATH']}", 'ABRITAMR_CACHE': f"{tmp_path / 'cache'}"}
+
+
+def _two_assemblies(tmp_path):
+    """
+    a batch of two samples with different assemblies
+    """
+    for i in [1, 2]:
+        (tmp_path / f"contigs{i}.fa").write_text((test_folder / 'contigs.fa').read_text() + 'acgt' * i + '\n')
+    (tmp_path / 'batch.txt').write_text(f"isolate1\t{tmp_path / 'contigs1.fa'}\nisolate2\t{tmp_path / 'contigs2.fa'}\n")
+
+
+RunArgs = collections.namedtuple('RunArgs', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity', 'amrfinder_db', 'stream', 'no_cache', 'cache_size', 'retries', 'multiplex', 'resume', 'stage_db', 'prewarm_db'], defaults = ['', False])
+def test_run_batch_cached(tmp_path, monkeypatch):
+    """
+    assert amrfinder is run for each sample the first time and the cached output is used the second time
+    """
+    monkeypatch.chdir(tmp_path)
+    _two_assemblies(tmp_path)
+    args = RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, False, 1024, 0, 0, False)
+    with patch.dict('os.environ', _fake_amrfinder(tmp_path)):
+        first = RunFinder(args).run()
+        assert first.failed == []
+        assert len((tmp_path / 'runs.txt').read_text().splitlines()) == 2
+        (tmp_path / 'isolate1' / 'amrfinder.out').unlink()
+        amr_obj = RunFinder(args)
+        amr_obj.run()
+        assert len((tmp_path / 'runs.txt').read_text().splitlines()) == 2
+        assert amr_obj.cache.hits == 2
+        assert (tmp_path / 'isolate1' / 'amrfinder.out').read_text() == (test_folder / 'amrfinder.out').read_text()
+
+
+def test_run_pipelined(tmp_path, monkeypatch):
+    """
+    assert collating each sample as its amrfinder run finishes gives the same summaries as collating after the batch
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'batch.txt').write_text(f"isolate1\t{test_folder / 'contigs.fa'}\nisolate2\t{test_folder / 'contigs.fa'}\n")
+    args = RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, True, 1024, 0, 0, False)
+    with patch.dict('os.environ', _fake_amrfinder(tmp_path)):
+        Collate(RunFinder(args).run()).run()
+        sequential = {f: (tmp_path / f).read_text() for f in ['summary_matches.txt', 'summary_partials.txt', 'abritamr.txt']}
+        amr_obj = RunFinder(args)
+        C = Collate(amr_obj.amr_data())
+        C.start_pipeline()
+        added = []
+        amr_obj.run(on_done = lambda sample: added.append(sample) or C.add(sample))
+        C.run()
+    assert sorted(added) == ['isolate1', 'isolate2']
+    assert {f: (tmp_path / f).read_text() for f in sequential} == sequential
+
+
+def test_run_multiplexed(tmp_path, monkeypatch):
+    """
+    assert running small assemblies together gives each sample the same amrfinder output as running them one at a time
+    """
+    monkeypatch.chdir(tmp_path)
+    env = _fake_amrfinder(tmp_path)
+    # an amrfinder that reports a hit on every contig of its input
+    (tmp_path / 'bin' / 'amrfinder').write_text(f"""#!{sys.executable}
+import sys
+if sys.argv[1] == '--version':
+    print('3.12.8')
+    sys.exit()
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+header, row = open('{test_folder / 'amrfinder.out'}').read().splitlines()[:2]
+contigs = [l[1:].split()[0] for l in open(args['-n']) if l.startswith('>')]
+with open(args['-o'], 'w') as out:
+    out.write(header + '\\n')
+    for contig in sorted(contigs):
+        fields = row.split('\\t')
+        fields[1] = contig
+        out.write('\\t'.join(fields) + '\\n')
+""")
+    for i in range(3):
+        (tmp_path / f"contigs{i}.fa").write_text(''.join(f">s{i}_contig{c} len=60\nACGT\n" for c in range(i + 1)))
+    (tmp_path / 'batch.txt').write_text(''.join(f"isolate{i}\t{tmp_path / f'contigs{i}.fa'}\n" for i in range(3)))
+    with patch.dict('os.environ', env):
+        RunFinder(RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, True, 1024, 0, 0, False)).run()
+        single = {i: (tmp_path / f"isolate{i}" / 'amrfinder.out').read_text() for i in range(3)}
+        amr_obj = RunFinder(RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, True, 1024, 0, 100, False))
+        assert len(amr_obj._plan_multiplex(amr_obj._get_samples())[0]) == 1
+        amr_obj.run()
+    assert {i: (tmp_path / f"isolate{i}" / 'amrfinder.out').read_text() for i in range(3)} == single
+    assert 's2_contig2' in single[2]
+    assert not list(tmp_path.glob('abritamr_multiplex_*'))
+
+
+def test_executor_schedule(tmp_path):
+    """
+    assert the largest jobs are started first and given the most threads, in proportion to their share of the work left
+    """
+    from abritamr.Executor import Executor, Job
+    executor = Executor(jobs = 8)
+    assert executor._threads(job = Job('a', [], '', 30), waiting = [Job('b', [], '', 1)] * 20, free = 8) == 5
+    assert executor._threads(job = Job('a', [], '', 30), waiting = [Job('b', [], '', 10)], free = 8) == 6
+    assert executor._threads(job = Job('a', [], '', 100), waiting = [Job('b', [], '', 1)], free = 8) == 7
+    assert executor._threads(job = Job('b', [], '', 10), waiting = [], free = 2) == 2
+    order = tmp_path / 'order.txt'
+    code = f"import sys; open('{order}', 'a').write(sys.argv[1] + ' ' + sys.argv[2] + '\\n')"
+    jobs = [Job(name, [sys.executable, '-c', code, name, '{threads}'], f"{tmp_path / name / 'amrfinder.err'}", size) for name, size in [('small', 1), ('large', 100), ('medium', 10)]]
+    Executor(jobs = 1).run(jobs)
+    assert order.read_text().splitlines() == ['large 1', 'medium 1', 'small 1']
+    order.unlink()
+    jobs = [Job(name, [sys.executable, '-c', code, name, '{threads}'], f"{tmp_path / name / 'amrfinder.err'}", size, group) for name, size, group in [('a1', 100, 'A'), ('b1', 110, 'B'), ('a2', 100, 'A'), ('c1', 1000, 'C'), ('a3', 10, 'A')]]
+    Executor(jobs = 1).run(jobs)
+    assert order.read_text().splitlines() == ['c1 1', 'a1 1', 'a2 1', 'b1 1', 'a3 1']
+    order.unlink()
+    jobs = [Job(name, [sys.executable, '-c', code, name, '{threads}'], f"{tmp_path / name / 'amrfinder.err'}", size) for name, size in [(f"small{n}", 10) for n in range(12)] + [('large', 1000)]]
+    Executor(jobs = 8).run(jobs)
+    threads = dict(line.split() for line in order.read_text().splitlines())
+    assert threads['large'] == '7'
+    assert all(int(t) < 7 for name, t in threads.items() if name != 'large')
+
+
+def test_run_resume(tmp_path, monkeypatch):
+    """
+    assert a resumed batch only runs the samples that did not complete, and a changed output is not taken as complete
+    """
+    import sqlite3
+    monkeypatch.chdir(tmp_path)
+    _two_assemblies(tmp_path)
+    args = RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, True, 1024, 0, 0, True)
+    with patch.dict('os.environ', _fake_amrfinder(tmp_path)):
+        RunFinder(args).run()
+        assert len((tmp_path / 'runs.txt').read_text().splitlines()) == 2
+        RunFinder(args).run()
+        assert len((tmp_path / 'runs.txt').read_text().splitlines()) == 2
+        out = tmp_path / 'isolate1' / 'amrfinder.out'
+        out.write_text(out.read_text()[:100])
+        RunFinder(args).run()
+        assert len((tmp_path / 'runs.txt').read_text().splitlines()) == 3
+    progress = json.loads((tmp_path / 'abritamr_progress.json').read_text())
+    assert (progress['completed'], progress['skipped'], progress['failed'], progress['finished']) == (2, 1, 0, True)
+    con = sqlite3.connect(tmp_path / 'abritamr_ledger.sqlite3')
+    assert con.execute("SELECT sample, state, returncode FROM samples ORDER BY sample").fetchall() == [('isolate1', 'done', 0), ('isolate2', 'done', 0)]
+
+
+def test_run_missing_output(tmp_path, monkeypatch):
+    """
+    assert a sample that amrfinder exits without error for but leaves no output is recorded as failed without stopping the batch
+    """
+    import sqlite3
+    monkeypatch.chdir(tmp_path)
+    _two_assemblies(tmp_path)
+    env = _fake_amrfinder(tmp_path)
+    fake = tmp_path / 'bin' / 'amrfinder'
+    fake.write_text(fake.read_text().replace('cp ', 'case $out in isolate2/*) exit 0;; esac\ncp '))
+    args = RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, True, 1024, 0, 0, False)
+    with patch.dict('os.environ', env):
+        amr_data = RunFinder(args).run()
+    assert amr_data.failed == ['isolate2']
+    con = sqlite3.connect(tmp_path / 'abritamr_ledger.sqlite3')
+    assert con.execute("SELECT sample, state, returncode, checksum FROM samples ORDER BY sample").fetchall()[1] == ('isolate2', 'failed', 0, None)
+    progress = json.loads((tmp_path / 'abritamr_progress.json').read_text())
+    assert (progress['completed'], progress['failed']) == (1, 1)
+
+
+def test_run_deduplicated(tmp_path, monkeypatch):
+    """
+    assert amrfinder is run once for assemblies with the same content and the output shared with each sample
+    """
+    monkeypatch.chdir(tmp_path)
+    _two_assemblies(tmp_path)
+    (tmp_path / 'copy.fa').write_text((tmp_path / 'contigs1.fa').read_text())
+    with open(tmp_path / 'batch.txt', 'a') as b:
+        b.write(f"isolate3\t{tmp_path / 'copy.fa'}\n")
+    args = RunArgs('batch', 'batch.txt', '', 2, '', '', 'db/2024-07-22.1', False, True, 1024, 0, 0, False)
+    done = []
+    with patch.dict('os.environ', _fake_amrfinder(tmp_path)):
+        amr_data = RunFinder(args).run(on_done = done.append)
+    assert len((tmp_path / 'runs.txt').read_text().splitlines()) == 2
+    assert sorted(done) == ['isolate1', 'isolate2', 'isolate3']
+    assert amr_data.failed == []
+    assert (tmp_path / 'isolate3' / 'amrfinder.out').read_text() == (tmp_path / 'isolate1' / 'amrfinder.out').read_text()
+
+
+def test_batch_organism_column(tmp_path):
+    """
+    assert the organism in the third column of the batch file is checked and used for that sample only
+    """
+    batch = tmp_path / 'batch.txt'
+    batch.write_text(f"isolate1\t{test_folder / 'contigs.fa'}\tSalmonella\nisolate2\t{test_folder / 'contigs.fa'}\n")
+    with patch.object(SetupAMR, "__init__", lambda x: None):
+        amr_obj = SetupAMR()
+        amr_obj.contigs = f"{batch}"
+        amr_obj.species_list = ['Salmonella']
+        amr_obj.logger = logging.getLogger(__name__)
+        assert amr_obj._get_input_shape() == 'batch'
+        batch.write_text(f"isolate1\t{test_folder / 'contigs.fa'}\tNot_a_species\n")
+        with pytest.raises(SystemExit):
+            amr_obj._get_input_shape()
+    batch.write_text(f"isolate1\t{test_folder / 'contigs.fa'}\tSalmonella\nisolate2\t{test_folder / 'contigs.fa'}\n")
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = RunFinder()
+        amr_obj.input = f"{batch}"
+        amr_obj.organism = ''
+        amr_obj.amrfinder_db = ''
+        amr_obj.identity = ''
+        jobs = {j.name: j for j in amr_obj._batch_cmd()}
+        assert jobs['isolate1'].cmd[-2:] == ['--organism', 'Salmonella']
+        assert jobs['isolate1'].group == 'Salmonella'
+        assert '--organism' not in jobs['isolate2'].cmd
+
+
+def test_staged_db(tmp_path):
+    """
+    assert the DB is copied, checked and removed at the end - and that the source is used if it can not be staged
+    """
+    db = tmp_path / '2024-07-22.1'
+    (db / 'sub').mkdir(parents = True)
+    (db / 'version.txt').write_text('2024-07-22.1\n')
+    (db / 'sub' / 'AMRProt').write_bytes(b'x' * 1000)
+    dest = tmp_path / 'shm'
+    dest.mkdir()
+    assert prewarm(db) == 1013
+    with StagedDB(source = db, dest = dest) as staged:
+        staged = pathlib.Path(staged)
+        assert staged.name == db.name
+        assert staged.parent.parent == dest
+        assert (staged / 'sub' / 'AMRProt').read_bytes() == b'x' * 1000
+    assert list(dest.iterdir()) == []
+    with StagedDB(source = db, dest = tmp_path / 'missing') as staged:
+        assert staged == f"{db}"
+
+
+def test_progress(tmp_path):
+    """
+    assert the progress file has the counts of the batch, and no estimate of the time left until a sample has been run
+    """
+    progress = Progress(total = 3, path = tmp_path / 'progress.json')
+    progress.complete('isolate1', skipped = True)
+    progress.EVERY = 0
+    progress.fail('isolate2')
+    state = json.loads((tmp_path / 'progress.json').read_text())
+    assert (state['completed'], state['failed'], state['remaining'], state['eta_seconds']) == (1, 1, 1, None)
+    progress.complete('isolate3')
+    progress.finish()
+    state = json.loads((tmp_path / 'progress.json').read_text())
+    assert (state['remaining'], state['eta_seconds'], state['finished']) == (0, 0, True)
+    assert progress.line(state).startswith('2/3 samples complete, 1 failed')
+
+
+def test_run_report(tmp_path, monkeypatch):
+    """
+    assert a report made at the end of a run, from the summaries in memory, is the same as one made afterwards from the summary files
+    """
+    from abritamr.abritamr import main
+    monkeypatch.chdir(tmp_path)
+    _two_assemblies(tmp_path)
+    (tmp_path / 'qc.csv').write_text("ISOLATE,SPECIES_EXP,SPECIES_OBS,TEST_QC\nisolate1,Salmonella enterica,Salmonella enterica,PASS\nisolate2,Shigella sonnei,Escherichia coli,PASS\n")
+    with patch.dict('os.environ', _fake_amrfinder(tmp_path)):
+        monkeypatch.setattr(sys, 'argv', ['abritamr', 'run', '-c', 'batch.txt', '-j', '2', '--no_cache', '--report', '--qc', 'qc.csv', '-r', 'fused', '--sop_name', 'gen', '--formats', 'csv'])
+        main()
+    monkeypatch.setattr(sys, 'argv', ['abritamr', 'report', '--qc', 'qc.csv', '-r', 'separate', '--sop_name', 'gen', '--formats', 'csv'])
+    main()
+    for sheet in ['gen', 'Passed_QC_partial']:
+        assert (tmp_path / f"fused_gen_{sheet}.csv").read_text() == (tmp_path / f"separate_gen_{sheet}.csv").read_text()
+    assert 'isolate2,,CTX-M-15' in (tmp_path / 'fused_gen_gen.csv').read_text()